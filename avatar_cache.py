@@ -0,0 +1,85 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+
+class AvatarCache:
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.index = self._load_index()
+        self.dirty = False
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.INDEX_FILE), 'r') as index_file:
+                return json.load(index_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            logger.warning(f'Could not read avatar cache index, starting empty: {exc}')
+            return {}
+
+    def _avatar_path(self, user_id):
+        # Rocket.Chat ids are alphanumeric, anything else is hashed so it cannot point outside of cache_dir
+        if not re.fullmatch(r'[A-Za-z0-9]+', str(user_id)):
+            user_id = '_' + hashlib.sha1(str(user_id).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{user_id}.img')
+
+    def get(self, user_id):
+        entry = self.index.get(user_id)
+        if entry is None or not os.path.exists(self._avatar_path(user_id)):
+            return None
+        return entry
+
+    def read(self, user_id):
+        with open(self._avatar_path(user_id), 'rb') as avatar_file:
+            return avatar_file.read()
+
+    def put(self, user_id, content, version=None, etag=None, last_modified=None):
+        with open(self._avatar_path(user_id), 'wb') as avatar_file:
+            avatar_file.write(content)
+
+        previous = self.index.get(user_id) or {}
+        self.index[user_id] = {'version': version, 'etag': etag, 'last_modified': last_modified,
+                               'digest': self.digest(content), 'synced_digest': self.synced_digest(previous)}
+        self.dirty = True
+
+    def mark_synced(self, user_id, content):
+        # Only once the avatar was written to LDAP, so a failed write is retried by the next sync
+        entry = self.index.get(user_id)
+        digest = self.digest(content)
+        if entry is not None and entry.get('digest') == digest and entry.get('synced_digest') != digest:
+            entry['synced_digest'] = digest
+            self.dirty = True
+
+    @staticmethod
+    def synced_digest(entry):
+        # Entries cached before the synced digest was kept were synced when they were downloaded
+        return entry.get('synced_digest', entry.get('digest'))
+
+    def touch(self, user_id, version):
+        if self.index[user_id].get('version') != version:
+            self.index[user_id]['version'] = version
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(index_path + '.tmp', index_path)
+        self.dirty = False
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha256(content or b'').hexdigest()
@@ -0,0 +1,427 @@
+#!/bin/python3
+# Runs RCLDAPSync against in-process stand-ins of Rocket.Chat (REST and MongoDB) and LDAP, and reports the
+# wall time, peak RSS and call counts per action as JSON. Needs requirements-dev.txt.
+import collections
+import contextlib
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import random
+import resource
+import sys
+import time
+from urllib.parse import urlsplit, parse_qs
+
+import ldap3
+import mongomock
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from ldap_client import LDAPClient
+from rc_client import RocketChatClient, RocketChatMongoClient
+from rc_session import RateLimitedSession
+from rc_sync import RCLDAPSync
+
+logger = logging.getLogger(__name__)
+
+RC_HOST = 'http://rocketchat.benchmark'
+LDAP_BASE_DN = 'dc=example,dc=org'
+LDAP_BINDDN = f'cn=admin,{LDAP_BASE_DN}'
+LDAP_PASSWORD = 'benchmark'
+
+
+class CallCounter:
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def count(self, kind, name):
+        self.counts[f'{kind}:{name}'] += 1
+
+    def reset(self):
+        self.counts = collections.Counter()
+
+    def summary(self):
+        totals = collections.Counter()
+        for key, count in self.counts.items():
+            totals[key.split(':', 1)[0]] += count
+        return {'totals': dict(totals), 'calls': dict(sorted(self.counts.items()))}
+
+    @contextlib.contextmanager
+    def counting(self, cls, method_names, kind):
+        # Counts calls of the methods of cls inside the with block, the class is restored afterwards
+        originals = {method_name: cls.__dict__.get(method_name) for method_name in method_names}
+        for method_name in method_names:
+            self._wrap(cls, method_name, kind)
+        try:
+            yield
+        finally:
+            for method_name, original in originals.items():
+                if original is None:
+                    delattr(cls, method_name)
+                else:
+                    setattr(cls, method_name, original)
+
+    def _wrap(self, cls, method_name, kind):
+        method = getattr(cls, method_name)
+
+        @functools.wraps(method)
+        def counted(*args, **kwargs):
+            self.count(kind, method_name)
+            return method(*args, **kwargs)
+        setattr(cls, method_name, counted)
+
+
+class SyntheticDataset:
+    def __init__(self, users=1000, channels=50, members_per_channel=100, avatar_size=4096, private_ratio=0.2,
+                 default_avatar_ratio=0.2, seed=0):
+        self.random = random.Random(seed)
+        self.avatar_size = avatar_size
+        self.now = datetime.datetime(2020, 1, 1)
+
+        self.users = {}
+        for i in range(users):
+            user_id = f'user-id-{i}'
+            # Users with the default avatar have neither avatarOrigin nor avatarETag
+            default_avatar = self.random.random() < default_avatar_ratio
+            self.users[user_id] = {
+                '_id': user_id, 'username': f'user{i}', 'name': f'User {i}', 'roles': ['user'],
+                'emails': [{'address': f'user{i}@example.org', 'verified': True}],
+                'services': {'password': {'bcrypt': f'$2b$10$benchmark{i:022d}'},
+                             'resume': {'loginTokens': [{'hashedToken': f'token-{i}-{t}'} for t in range(5)]}},
+                'customFields': {}, 'avatarOrigin': None if default_avatar else 'upload',
+                'avatarETag': None if default_avatar else f'etag-{i}-0', '_updatedAt': self.now,
+            }
+
+        self.rooms = {}
+        self.members = {}
+        user_ids = list(self.users)
+        for i in range(channels):
+            room_id = f'room-id-{i}'
+            room_type = 'p' if self.random.random() < private_ratio else 'c'
+            self.rooms[room_id] = {'_id': room_id, 'name': f'channel-{i}', 't': room_type, '_updatedAt': self.now}
+            self.members[room_id] = set(self.random.sample(user_ids, min(members_per_channel, len(user_ids))))
+
+        self.mongo_client = mongomock.MongoClient()
+        self._fill_mongo()
+
+    def _fill_mongo(self):
+        db = self.mongo_client.get_database('rocketchat')
+        for collection in ('users', 'rocketchat_room', 'rocketchat_subscription'):
+            db.drop_collection(collection)
+
+        db.users.insert_many([dict(user) for user in self.users.values()])
+        db.rocketchat_room.insert_many([dict(room) for room in self.rooms.values()])
+        subscriptions = [self._subscription(room_id, user_id)
+                         for room_id, member_ids in self.members.items() for user_id in member_ids]
+        if subscriptions:
+            db.rocketchat_subscription.insert_many(subscriptions)
+
+    def _subscription(self, room_id, user_id):
+        room, user = self.rooms[room_id], self.users[user_id]
+        return {'_id': f'{room_id}-{user_id}', 'rid': room_id, 'name': room['name'], 't': room['t'],
+                'u': {'_id': user_id, 'username': user['username']}, '_updatedAt': self.now}
+
+    def apply_changes(self, change_rate):
+        # Renames users, changes their avatars and moves them between channels
+        self.now += datetime.timedelta(hours=1)
+        user_ids = list(self.users)
+        for user_id in self.random.sample(user_ids, int(len(user_ids) * change_rate)):
+            user = self.users[user_id]
+            user['name'] += ' (changed)'
+            if user['avatarETag'] is not None:
+                user['avatarETag'] = f'{user["avatarETag"]}+'
+            user['_updatedAt'] = self.now
+
+        for room_id, member_ids in self.members.items():
+            moves = int(len(member_ids) * change_rate)
+            if not moves:
+                continue
+            for user_id in self.random.sample(sorted(member_ids), moves):
+                member_ids.discard(user_id)
+            member_ids.update(self.random.sample(user_ids, moves))
+            self.rooms[room_id]['_updatedAt'] = self.now
+
+        self._fill_mongo()
+
+    def avatar(self, user):
+        # The default avatar is rendered from the username
+        seed = hashlib.sha256((user['avatarETag'] or user['username']).encode()).digest()
+        return (seed * (self.avatar_size // len(seed) + 1))[:self.avatar_size]
+
+    def find_user(self, user_id=None, username=None):
+        if user_id is not None:
+            return self.users.get(user_id)
+        return next((user for user in self.users.values() if user['username'] == username), None)
+
+    def find_room(self, name, room_type=None):
+        return next((room for room in self.rooms.values()
+                     if room['name'] == name and (room_type is None or room['t'] == room_type)), None)
+
+
+class FakeRocketChatAdapter(BaseAdapter):
+    # Answers the REST endpoints the sync uses from a SyntheticDataset
+    PAGE_SIZE = 50
+
+    def __init__(self, dataset, counter):
+        super().__init__()
+        self.dataset = dataset
+        self.counter = counter
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        endpoint = url.path.rsplit('/', 1)[-1] if url.path.startswith('/api/v1/') else url.path
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if request.body:
+            # rocketchat_API logs in with a form, everything else is JSON
+            body = request.body.decode() if isinstance(request.body, bytes) else request.body
+            if 'json' in request.headers.get('Content-Type', ''):
+                params.update(json.loads(body))
+            else:
+                params.update({key: values[0] for key, values in parse_qs(body).items()})
+        self.counter.count('rest', endpoint)
+
+        handler = getattr(self, 'handle_' + endpoint.replace('.', '_').replace('/', '_').strip('_'), None)
+        if handler is None:
+            return self._response(request, 404, {'success': False, 'error': f'Unknown endpoint {endpoint}'})
+        return handler(request, params)
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _response(request, status_code, body=None, content=None, headers=None):
+        response = Response()
+        response.status_code = status_code
+        response.request = request
+        response.url = request.url
+        response.headers = CaseInsensitiveDict(headers or {'Content-Type': 'application/json'})
+        response.encoding = 'utf-8'
+        response._content = content if content is not None else json.dumps(body, default=str).encode()
+        return response
+
+    def _page(self, request, params, key, items):
+        offset, count = int(params.get('offset', 0)), int(params.get('count', self.PAGE_SIZE))
+        page = items[offset:offset + count]
+        return self._response(request, 200, {key: page, 'count': len(page), 'offset': offset, 'total': len(items),
+                                             'success': True})
+
+    @staticmethod
+    def _public_user(user):
+        return {key: value for key, value in user.items() if key != 'services'}
+
+    def _members(self, room):
+        return [{'_id': user_id, 'username': self.dataset.users[user_id]['username']}
+                for user_id in sorted(self.dataset.members[room['_id']])]
+
+    def handle_api_info(self, request, params):
+        return self._response(request, 200, {'info': {'version': '3.9.0'}, 'success': True})
+
+    def handle_login(self, request, params):
+        return self._response(request, 200, {'status': 'success',
+                                             'data': {'authToken': 'benchmark-token', 'userId': 'admin-id',
+                                                      'me': {'_id': 'admin-id', 'username': 'admin'}}})
+
+    def handle_me(self, request, params):
+        return self._response(request, 200, {'_id': 'admin-id', 'username': 'admin', 'success': True})
+
+    def handle_users_list(self, request, params):
+        users = [self._public_user(user) for user in self.dataset.users.values()]
+        return self._page(request, params, 'users', users)
+
+    def handle_users_info(self, request, params):
+        user = self.dataset.find_user(params.get('userId'), params.get('username'))
+        if user is None:
+            return self._response(request, 404, {'success': False, 'error': 'User not found'})
+        return self._response(request, 200, {'user': user, 'success': True})
+
+    def handle_users_getAvatar(self, request, params):
+        user = self.dataset.find_user(params.get('userId'), params.get('username'))
+        if user is None:
+            return self._response(request, 404, {'success': False})
+
+        if user['avatarETag'] is None:
+            return self._response(request, 200, content=self.dataset.avatar(user),
+                                  headers={'Content-Type': 'image/svg+xml'})
+
+        etag = f'"{user["avatarETag"]}"'
+        if request.headers.get('If-None-Match') == etag:
+            return self._response(request, 304, content=b'', headers={'ETag': etag})
+        return self._response(request, 200, content=self.dataset.avatar(user),
+                              headers={'Content-Type': 'image/png', 'ETag': etag})
+
+    def _room_info(self, request, params, room_type, key):
+        room = self.dataset.find_room(params.get('roomName'), room_type)
+        if room is None:
+            return self._response(request, 400, {'success': False, 'error': 'error-room-not-found'})
+        return self._response(request, 200, {key: room, 'success': True})
+
+    def handle_channels_info(self, request, params):
+        return self._room_info(request, params, 'c', 'channel')
+
+    def handle_groups_info(self, request, params):
+        return self._room_info(request, params, 'p', 'group')
+
+    def _room_members(self, request, params):
+        room = self.dataset.rooms.get(params.get('roomId'))
+        if room is None:
+            return self._response(request, 400, {'success': False, 'error': 'error-room-not-found'})
+        return self._page(request, params, 'members', self._members(room))
+
+    def handle_channels_members(self, request, params):
+        return self._room_members(request, params)
+
+    def handle_groups_members(self, request, params):
+        return self._room_members(request, params)
+
+    def handle_channels_list(self, request, params):
+        return self._page(request, params, 'channels', [room for room in self.dataset.rooms.values()
+                                                        if room['t'] == 'c'])
+
+    def handle_groups_listAll(self, request, params):
+        return self._page(request, params, 'groups', [room for room in self.dataset.rooms.values()
+                                                      if room['t'] == 'p'])
+
+    def _invite(self, request, params):
+        room = self.dataset.rooms.get(params.get('roomId'))
+        user_ids = params.get('userIds') or [params.get('userId')]
+        if room is None or any(user_id not in self.dataset.users for user_id in user_ids):
+            return self._response(request, 400, {'success': False, 'error': 'error-invalid-user'})
+        self.dataset.members[room['_id']].update(user_ids)
+        return self._response(request, 200, {'success': True})
+
+    def handle_channels_invite(self, request, params):
+        return self._invite(request, params)
+
+    def handle_groups_invite(self, request, params):
+        return self._invite(request, params)
+
+    def handle_groups_create(self, request, params):
+        if self.dataset.find_room(params.get('name')) is not None:
+            return self._response(request, 400, {'success': False, 'errorType': 'error-duplicate-channel-name'})
+        room_id = f'room-id-{len(self.dataset.rooms)}'
+        room = {'_id': room_id, 'name': params.get('name'), 't': 'p', '_updatedAt': self.dataset.now}
+        self.dataset.rooms[room_id] = room
+        self.dataset.members[room_id] = set()
+        return self._response(request, 200, {'group': room, 'success': True})
+
+
+def _create_ldap_server():
+    server = ldap3.Server('ldap-benchmark')
+    connection = ldap3.Connection(server, user=LDAP_BINDDN, password=LDAP_PASSWORD, client_strategy=ldap3.MOCK_SYNC)
+    connection.strategy.add_entry(LDAP_BASE_DN, {'objectClass': ['dcObject', 'organization'], 'dc': 'example'})
+    connection.strategy.add_entry(LDAP_BINDDN, {'objectClass': ['person'], 'cn': 'admin', 'sn': 'admin',
+                                                'userPassword': LDAP_PASSWORD})
+    for ou in ('users', 'groups'):
+        connection.strategy.add_entry(f'ou={ou},{LDAP_BASE_DN}', {'objectClass': ['organizationalUnit'], 'ou': ou})
+    return server
+
+
+def run_benchmark(users=1000, channels=50, members_per_channel=100, avatar_size=4096, change_rate=0.05,
+                  private_ratio=0.2, default_avatar_ratio=0.2, use_mongodb=True, workers=1, pipeline_writes=False,
+                  avatar_cache_dir=None, actions=tuple(RCLDAPSync.ACTIONS), seed=0):
+    dataset = SyntheticDataset(users=users, channels=channels, members_per_channel=members_per_channel,
+                               avatar_size=avatar_size, private_ratio=private_ratio,
+                               default_avatar_ratio=default_avatar_ratio, seed=seed)
+    counter = CallCounter()
+    with counter.counting(ldap3.Connection, ('search', 'add', 'modify', 'delete'), 'ldap'), \
+            counter.counting(mongomock.collection.Collection, ('find', 'find_one', 'aggregate'), 'mongo'):
+        results = _run_phases(dataset, counter, change_rate=change_rate, use_mongodb=use_mongodb, workers=workers,
+                              pipeline_writes=pipeline_writes, avatar_cache_dir=avatar_cache_dir, actions=actions)
+
+    return {'parameters': {'users': users, 'channels': channels, 'members_per_channel': members_per_channel,
+                           'avatar_size': avatar_size, 'change_rate': change_rate, 'private_ratio': private_ratio,
+                           'default_avatar_ratio': default_avatar_ratio, 'use_mongodb': use_mongodb,
+                           'workers': workers, 'pipeline_writes': pipeline_writes,
+                           'avatar_cache': avatar_cache_dir is not None, 'seed': seed},
+            'results': results}
+
+
+def _run_phases(dataset, counter, change_rate, use_mongodb, workers, pipeline_writes, avatar_cache_dir, actions):
+    session = RateLimitedSession()
+    session.mount(RC_HOST, FakeRocketChatAdapter(dataset, counter))
+    rc_client = RocketChatClient('admin', 'admin', host=RC_HOST, session=session, avatar_cache_dir=avatar_cache_dir,
+                                 mongo=RocketChatMongoClient(mongo_cli=dataset.mongo_client))
+    rc_client.USE_MONGODB = use_mongodb
+
+    ldap_client = LDAPClient(binddn=LDAP_BINDDN, password=LDAP_PASSWORD, base_dn=LDAP_BASE_DN,
+                             default_users_objectclasses=['inetOrgPerson'],
+                             default_groups_objectclasses=['groupOfNames'],
+                             default_users_basedn='ou=users', default_groups_basedn='ou=groups',
+                             ldap_server=_create_ldap_server(), client_strategy=ldap3.MOCK_SYNC,
+                             async_client_strategy=ldap3.MOCK_ASYNC)
+
+    sync_groups = {'benchmark': {'groups_basedn': 'ou=groups', 'users_basedn': f'ou=users,{LDAP_BASE_DN}',
+                                 'channels': {room['name']: f'cn={room["name"]}'
+                                              for room in dataset.rooms.values()}}}
+    rcldap_sync = RCLDAPSync(rc_client, ldap_client, sync=sync_groups, workers=workers,
+                             pipeline_writes=pipeline_writes)
+
+    results = []
+    for phase in ('initial', 'changed', 'unchanged'):
+        if phase == 'changed':
+            dataset.apply_changes(change_rate)
+
+        rcldap_sync.start_run()
+        for action in actions:
+            counter.reset()
+            started = time.perf_counter()
+            rcldap_sync.run_action(action)
+            results.append({'phase': phase, 'action': action,
+                            'wall_time_seconds': round(time.perf_counter() - started, 4),
+                            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                            **counter.summary()})
+        rcldap_sync.checkpoint()
+
+    rcldap_sync.close()
+    return results
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the sync against synthetic RC/LDAP stand-ins')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--members_per_channel', type=int, default=100)
+    parser.add_argument('--avatar_size', type=int, default=4096)
+    parser.add_argument('--change_rate', type=float, default=0.05,
+                        help='Fraction of users and memberships changed before the second run')
+    parser.add_argument('--private_ratio', type=float, default=0.2)
+    parser.add_argument('--default_avatar_ratio', type=float, default=0.2,
+                        help='Fraction of users with the default avatar, which has no avatarETag')
+    parser.add_argument('--no_mongodb', action="store_true")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--pipeline_writes', action="store_true")
+    parser.add_argument('--avatar_cache_dir', type=str, help='Use an avatar cache in this (preferably empty) dir')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='Write the JSON report here instead of stdout')
+    # No choices, argparse checks the empty default of nargs='*' against them and fails
+    parser.add_argument('actions', nargs='*', metavar='action',
+                        help=f'Actions to benchmark, all by default: {", ".join(RCLDAPSync.ACTIONS)}')
+    _args = parser.parse_args()
+
+    unknown_actions = [action for action in _args.actions if action not in RCLDAPSync.ACTIONS]
+    if unknown_actions:
+        parser.error(f'invalid actions {unknown_actions} (choose from {", ".join(RCLDAPSync.ACTIONS)})')
+    _args.actions = _args.actions or RCLDAPSync.ACTIONS
+    return _args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    report = run_benchmark(users=args.users, channels=args.channels, members_per_channel=args.members_per_channel,
+                           avatar_size=args.avatar_size, change_rate=args.change_rate,
+                           private_ratio=args.private_ratio, default_avatar_ratio=args.default_avatar_ratio,
+                           use_mongodb=not args.no_mongodb, workers=args.workers,
+                           pipeline_writes=args.pipeline_writes, avatar_cache_dir=args.avatar_cache_dir,
+                           actions=args.actions, seed=args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
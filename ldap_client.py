@@ -1,13 +1,74 @@
+import datetime
 import ldap3
 import logging
+import re
+import threading
+import time
+from ldap3.core.exceptions import LDAPBindError, LDAPException
+
+from ldap_plan import ChangePlan, PlanExecutor
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 
+def normalize_dn(dn):
+    return ",".join(rdn.strip() for rdn in dn.split(",")).lower()
+
+
+def _is_under(normalized_dn, normalized_base_dn):
+    return normalized_dn == normalized_base_dn or normalized_dn.endswith(',' + normalized_base_dn)
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if type(value) is list else [value]
+
+
+def _normalized_values(value):
+    # Servers return str or bytes, single values or lists, depending on their schema. Photos stay bytes.
+    return [bytes(item) if isinstance(item, (bytes, bytearray)) else str(item).encode() for item in _as_list(value)]
+
+
+def _first_value(value):
+    if type(value) is list:
+        return value[0] if value else None
+    return value
+
+
+def _split_hosts(hosts):
+    # A list, or a string with several hosts separated by commas or spaces
+    if hosts is None:
+        return []
+    if isinstance(hosts, str):
+        return [host for host in re.split(r'[,\s]+', hosts) if host]
+    return list(hosts)
+
+
 class LDAPClient:
+    # Large membership changes are split into several modify operations
+    MEMBER_CHANGES_CHUNK_SIZE = 1000
+    # The user snapshot only holds what reconciliation compares, the photos are read per entry when needed
+    USER_ATTRIBUTES = ['objectClass', 'uid', 'cn', 'mail', 'userPassword', 'rocketchatId']
+    LAZY_USER_ATTRIBUTES = ['thumbnailPhoto', 'jpegPhoto']
+    PAGE_SIZE = 500
+    CONNECT_TIMEOUT = 5
+    RECEIVE_TIMEOUT = 60
+    # Unreachable servers are left out of the pool for this many seconds
+    SERVER_EXHAUST_SECONDS = 60
+    # Cycles through the pool before an operation gives up
+    SERVER_POOL_CYCLES = 3
+    # Stale users are deleted in batches, with a pause in between to not flood the provider and its replicas
+    DELETE_BATCH_SIZE = 100
+    DELETE_BATCH_PAUSE_SECONDS = 1
+    # Revalidating a warm start also fetches entries modified a bit before it was loaded, against clock skew
+    REVALIDATE_OVERLAP = datetime.timedelta(minutes=5)
+
     def __init__(self, binddn="", password="", host="ldap://ldap:389", base_dn="", default_users_objectclasses=None,
                  default_groups_objectclasses=None, default_groups_basedn="", default_users_basedn="",
-                 log_level=logging.INFO):
+                 log_level=logging.INFO, ldap_server=None, client_strategy=ldap3.RESTARTABLE,
+                 async_client_strategy=ldap3.ASYNC, read_hosts=None, read_ldap_server=None, warm_start=None):
         logger.setLevel(log_level)
 
         self.ldap_base_dn = base_dn
@@ -18,12 +79,114 @@ class LDAPClient:
         self.ldap_groups_objectclasses = self.default_groups_objectclasses = \
             default_groups_objectclasses if default_groups_objectclasses is not None else []
 
-        self.ldap_server = ldap3.Server(host, get_info=ldap3.ALL)
-        self.ldap_connection = ldap3.Connection(self.ldap_server, user=binddn, password=password)
-        if not self.ldap_connection.bind():
-            logger.error('Could not bind to LDAP! Invalid credentials? Wrong host?')
+        self.binddn = binddn
+        self.password = password
+        # Writes go to the first reachable provider, reads optionally round robin to replicas
+        self.ldap_server = ldap_server if ldap_server is not None else self._create_server(host, ldap3.FIRST)
+        self.read_ldap_server = read_ldap_server
+        if read_ldap_server is None and _split_hosts(read_hosts):
+            self.read_ldap_server = self._create_server(read_hosts, ldap3.ROUND_ROBIN)
+        self.client_strategy = client_strategy
+        self.async_client_strategy = async_client_strategy
+        # ldap3 connections are not thread safe, so every worker thread gets its own
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        self.user_dns_by_rocketchat_id = {}
+        self.user_dns_by_uid = {}
+        # dn -> (rocketchatId, uid) it is indexed under, so it can be unindexed without scanning the indexes
+        self.user_index_keys = {}
+        # Guards the indexes, snapshots and all_users against the workers
+        self._users_lock = threading.RLock()
+        # (normalized base dn, objectClasses) -> {dn: entry}, shared by all SYNC groups until refreshed
+        self.user_snapshots = {}
+        # snapshot key -> when it was loaded from LDAP (UTC)
+        self.snapshot_loaded_at = {}
+        warm_users = warm_start.get_ldap_users(self.snapshot_key(base_dn)) if warm_start is not None else None
+        if warm_users is not None:
+            self._revalidate_users_snapshot(base_dn, *warm_users)
+        self.all_users = self.get_users_snapshot(base_dn)
+
+        # While a plan is recorded, writes are collected in it instead of being sent
+        self.plan = None
+
+    def _create_server(self, hosts, pool_strategy):
+        servers = [ldap3.Server(host, get_info=ldap3.ALL, connect_timeout=self.CONNECT_TIMEOUT)
+                   for host in _split_hosts(hosts)]
+        if len(servers) == 1:
+            return servers[0]
+        return ldap3.ServerPool(servers, pool_strategy, active=self.SERVER_POOL_CYCLES,
+                                exhaust=self.SERVER_EXHAUST_SECONDS)
+
+    def _get_connection(self, name, server):
+        connection = getattr(self._local, name, None)
+        if connection is None:
+            # The restartable strategy reconnects and binds again if the server dropped the connection
+            connection = ldap3.Connection(server, user=self.binddn, password=self.password,
+                                          client_strategy=self.client_strategy, receive_timeout=self.RECEIVE_TIMEOUT)
+            if not connection.bind():
+                logger.error('Could not bind to LDAP! Invalid credentials? Wrong host?')
+                raise LDAPBindError(f'Could not bind to LDAP as {self.binddn}: {connection.result}')
+
+            setattr(self._local, name, connection)
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    @property
+    def ldap_connection(self):
+        # Writes, and reads whose results are written back right away
+        return self._get_connection('connection', self.ldap_server)
 
-        self.all_users = self.get_all_users(base_dn)
+    @property
+    def ldap_read_connection(self):
+        # Bulk reads, which may lag behind the provider a bit
+        if self.read_ldap_server is None:
+            return self.ldap_connection
+        return self._get_connection('read_connection', self.read_ldap_server)
+
+    def unbind(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.unbind()
+            self._connections = []
+        self._local = threading.local()
+
+    def begin_plan(self):
+        self.plan = ChangePlan(max_values=self.MEMBER_CHANGES_CHUNK_SIZE)
+
+    def end_plan(self):
+        plan, self.plan = self.plan, None
+        return plan
+
+    def create_plan_executor(self, connections=1):
+        return PlanExecutor(self.ldap_server, self.binddn, self.password, connections=connections,
+                            client_strategy=self.async_client_strategy)
+
+    def _add(self, dn, object_class, attributes):
+        metrics.inc('ldap_changes_total', operation='add', planned=self.plan is not None)
+        if self.plan is not None:
+            self.plan.add(dn, object_class, attributes)
+            return True
+        with metrics.timer('ldap_operation_seconds', operation='add'):
+            return self.ldap_connection.add(dn, object_class=object_class, attributes=attributes)
+
+    def _modify(self, dn, changes):
+        metrics.inc('ldap_changes_total', operation='modify', planned=self.plan is not None)
+        if self.plan is not None:
+            self.plan.modify(dn, changes)
+            return True
+        with metrics.timer('ldap_operation_seconds', operation='modify'):
+            return self.ldap_connection.modify(dn, changes)
+
+    def _delete(self, dn):
+        metrics.inc('ldap_changes_total', operation='delete', planned=self.plan is not None)
+        if self.plan is not None:
+            self.plan.delete(dn)
+            return True
+        with metrics.timer('ldap_operation_seconds', operation='delete'):
+            return self.ldap_connection.delete(dn)
 
     def update_settings(self, settings):
         self.ldap_groups_basedn = settings.get('groups_basedn', self.default_ldap_groups_basedn)
@@ -37,113 +200,336 @@ class LDAPClient:
         self.ldap_users_objectclasses = settings.get('users_objectclasses', self.default_users_objectclasses)
         self.ldap_groups_objectclasses = settings.get('groups_objectclasses', self.default_groups_objectclasses)
 
-        self.all_users = self.get_all_users(self.ldap_users_basedn)
+        self.all_users = self.get_users_snapshot(self.ldap_users_basedn)
 
-    def get_group_member_dns(self, group_name):
+    def get_group_members(self, group_name):
+        # (member DNs, memberUid values) of the group, None if it does not exist
         group_dn = f"{group_name},{self.ldap_groups_basedn}"
 
-        self.ldap_connection.search(group_dn, '(objectClass=*)',
-                                    attributes=['member', 'memberUid'])
+        with metrics.timer('ldap_operation_seconds', operation='search_group'):
+            self.ldap_connection.search(group_dn, '(objectClass=*)',
+                                        attributes=['member', 'memberUid'])
         if not self.ldap_connection.response:
             return None
 
         attrs = self.ldap_connection.response[0].get('attributes', {})
-        return [f"uid={i},{self.ldap_groups_basedn}" for i in attrs.get('memberUid')] + attrs.get('member', [])
-        # return [i.split('=', 1)[1].split(',')[0] for i in attrs['member']] + attrs['memberUid']
+        return _as_list(attrs.get('member')), _as_list(attrs.get('memberUid'))
+
+    def get_group_member_dns(self, group_name):
+        # Everyone in the group, memberUid values as DNs. Only for reading, they are no values of member.
+        members = self.get_group_members(group_name)
+        if members is None:
+            return None
+
+        member_dns, member_uids = members
+        return [f"uid={i},{self.ldap_groups_basedn}" for i in member_uids] + member_dns
 
     def set_group_members(self, group_dn, member_dns, current_members=None):
         if self.ldap_groups_basedn not in group_dn:
             group_dn = ",".join([group_dn, self.ldap_groups_basedn])
 
-        if current_members:
-            logger.debug(f'Replacing members of {group_dn} with members:\n{member_dns}')
-            return self.ldap_connection.modify(group_dn, {'member': [(ldap3.MODIFY_REPLACE, member_dns)]})
-        else:
+        if current_members is None:
             logger.debug(f'Adding group {group_dn} with members:\n{member_dns}')
-            return self.ldap_connection.add(group_dn, object_class=self.ldap_groups_objectclasses,
-                                            attributes={'member': member_dns})
+            return self._add(group_dn, self.ldap_groups_objectclasses, {'member': member_dns})
 
-    def get_user_by_rocketchat_id(self, rocketchat_id):
-        self.ldap_connection.search(self.ldap_base_dn, f'(rocketchatId={rocketchat_id})')
-        if not self.ldap_connection.response:
+        # Compare normalized DNs, but add/delete the values as they are, the server matches DNs itself
+        wanted = {normalize_dn(dn): dn for dn in member_dns}
+        current = {normalize_dn(dn): dn for dn in current_members}
+        to_add = [dn for normalized, dn in wanted.items() if normalized not in current]
+        to_delete = [dn for normalized, dn in current.items() if normalized not in wanted]
+        if not to_add and not to_delete:
+            return True
+
+        logger.debug(f'Changing members of {group_dn}, adding:\n{to_add}\nremoving:\n{to_delete}')
+        # Add first, so groups requiring a member never run empty
+        return (self._modify_members(group_dn, ldap3.MODIFY_ADD, to_add) and
+                self._modify_members(group_dn, ldap3.MODIFY_DELETE, to_delete))
+
+    def _modify_members(self, group_dn, operation, member_dns):
+        for i in range(0, len(member_dns), self.MEMBER_CHANGES_CHUNK_SIZE):
+            chunk = member_dns[i:i + self.MEMBER_CHANGES_CHUNK_SIZE]
+            if not self._modify(group_dn, {'member': [(operation, chunk)]}):
+                logger.error(f'Could not change members of {group_dn}: {self.ldap_connection.result}')
+                return False
+        return True
+
+    def get_user_dn_by_rocketchat_id(self, rocketchat_id):
+        dn = self.user_dns_by_rocketchat_id.get(rocketchat_id)
+        if dn is None:
             logger.debug(f'No user found with ID {rocketchat_id}')
-            return None
+        return dn
+
+    def get_user_dn_by_uid(self, uid):
+        return self.user_dns_by_uid.get(uid)
+
+    def _users_filter(self, extra_filter=''):
+        return f'(&{"".join([f"(objectClass={obc})" for obc in self.ldap_users_objectclasses])}{extra_filter})'
 
-        return self.ldap_connection.response[0]
+    def _search_users(self, base_dn, search_filter, attributes):
+        entries = self.ldap_read_connection.extend.standard.paged_search(
+            base_dn, search_filter, attributes=attributes, paged_size=self.PAGE_SIZE, generator=True)
 
+        users = {}
+        for entry in entries:
+            if entry.get('type') != 'searchResEntry':
+                continue
+            # Keep neither the raw_attributes nor the raw_dn, they would double the memory
+            dn = entry.get('dn')
+            users[dn] = {'dn': dn, 'attributes': dict(entry.get('attributes', {}))}
+        return users
+
+    @metrics.timed('ldap_operation_seconds', operation='search_users')
     def get_all_users(self, base_dn):
-        self.ldap_connection.search(base_dn,
-                                    f'(&{"".join([f"(objectClass={obc})" for obc in self.ldap_users_objectclasses])})',
-                                    attributes=ldap3.ALL_ATTRIBUTES)
-        return dict([(user.get('dn'), user) for user in self.ldap_connection.response])
+        all_users = self._search_users(base_dn, self._users_filter(), self.USER_ATTRIBUTES)
+        for dn, user in all_users.items():
+            self._index_user(dn, user.get('attributes'))
+        return all_users
+
+    @metrics.timed('ldap_operation_seconds', operation='revalidate_users')
+    def _revalidate_users_snapshot(self, base_dn, users, loaded_at):
+        # Brings a snapshot loaded at loaded_at up to date: one search for the DNs, to drop deleted entries, and one
+        # for the entries modified since
+        started_at = datetime.datetime.utcnow()
+        since = (loaded_at - self.REVALIDATE_OVERLAP).strftime('%Y%m%d%H%M%SZ')
+        try:
+            current_dns = self._search_users(base_dn, self._users_filter(), [ldap3.NO_ATTRIBUTES]).keys()
+            modified_users = self._search_users(base_dn, self._users_filter(f'(modifyTimestamp>={since})'),
+                                                self.USER_ATTRIBUTES)
+        except LDAPException as exc:
+            logger.warning(f'Could not revalidate the warm start snapshot, loading all users: {exc}')
+            return
+
+        for dn in users.keys() - current_dns:
+            del users[dn]
+        users.update(modified_users)
+        for dn, user in users.items():
+            self._index_user(dn, user.get('attributes'))
+
+        logger.info(f'Revalidated {len(users)} LDAP users, {len(modified_users)} modified since they were loaded')
+        key = self.snapshot_key(base_dn)
+        self.user_snapshots[key] = users
+        self.snapshot_loaded_at[key] = started_at
+
+    def snapshot_key(self, base_dn, objectclasses=None):
+        if objectclasses is None:
+            objectclasses = self.ldap_users_objectclasses
+        return normalize_dn(base_dn), tuple(sorted(objectclasses))
+
+    def get_users_snapshot(self, base_dn):
+        with self._users_lock:
+            return self._get_users_snapshot(base_dn)
+
+    def _get_users_snapshot(self, base_dn):
+        key = self.snapshot_key(base_dn)
+        if key in self.user_snapshots:
+            return self.user_snapshots[key]
+
+        for (snapshot_base_dn, snapshot_objectclasses), snapshot in list(self.user_snapshots.items()):
+            if snapshot_objectclasses == key[1] and _is_under(key[0], snapshot_base_dn):
+                # A snapshot of a parent already holds these users, share its entries
+                users = {dn: user for dn, user in snapshot.items() if _is_under(normalize_dn(dn), key[0])}
+                loaded_at = self.snapshot_loaded_at.get((snapshot_base_dn, snapshot_objectclasses))
+                break
+        else:
+            loaded_at = datetime.datetime.utcnow()
+            users = self.get_all_users(base_dn)
+
+        self.user_snapshots[key] = users
+        self.snapshot_loaded_at[key] = loaded_at
+        return users
+
+    def refresh_users_snapshots(self):
+        # The snapshot of the base DN is revalidated, the ones of the SYNC groups are derived from it again
+        self.ldap_users_objectclasses = self.default_users_objectclasses
+        key = self.snapshot_key(self.ldap_base_dn)
+        users, loaded_at = self.user_snapshots.get(key), self.snapshot_loaded_at.get(key)
+
+        self.user_snapshots = {}
+        self.snapshot_loaded_at = {}
+        self.user_dns_by_rocketchat_id = {}
+        self.user_dns_by_uid = {}
+        self.user_index_keys = {}
+        if users is not None and loaded_at is not None:
+            self._revalidate_users_snapshot(self.ldap_base_dn, users, loaded_at)
+        self.all_users = self.get_users_snapshot(self.ldap_base_dn)
+
+    def _add_to_snapshots(self, dn, user):
+        normalized_dn = normalize_dn(dn)
+        objectclasses = {objectclass.lower() for objectclass in _as_list(user.get('attributes', {}).get('objectClass'))}
+        for (snapshot_base_dn, snapshot_objectclasses), snapshot in self.user_snapshots.items():
+            if _is_under(normalized_dn, snapshot_base_dn) and \
+                    {objectclass.lower() for objectclass in snapshot_objectclasses} <= objectclasses:
+                snapshot[dn] = user
+
+    def _remove_from_snapshots(self, dn):
+        for snapshot in self.user_snapshots.values():
+            snapshot.pop(dn, None)
 
-    def add_or_update_user(self, dn, user_attributes, user_objectclasses=None):
+    def _get_lazy_user_attributes(self, dn):
+        with metrics.timer('ldap_operation_seconds', operation='search_photos'):
+            self.ldap_read_connection.search(dn, '(objectClass=*)', search_scope=ldap3.BASE,
+                                             attributes=self.LAZY_USER_ATTRIBUTES)
+        if not self.ldap_read_connection.response:
+            return {}
+        # The server may return the attribute names in another case
+        return {attribute_name.lower(): value
+                for attribute_name, value in self.ldap_read_connection.response[0].get('attributes', {}).items()}
+
+    def _index_user(self, dn, attributes):
+        rocketchat_id = _first_value(attributes.get('rocketchatId'))
+        uid = _first_value(attributes.get('uid'))
+        with self._users_lock:
+            self._unindex_user(dn)
+            if rocketchat_id:
+                self.user_dns_by_rocketchat_id[rocketchat_id] = dn
+            if uid:
+                self.user_dns_by_uid[uid] = dn
+            self.user_index_keys[dn] = (rocketchat_id, uid)
+
+    def _unindex_user(self, dn):
+        with self._users_lock:
+            rocketchat_id, uid = self.user_index_keys.pop(dn, (None, None))
+            # Only if no other entry took over the key in the meantime
+            if rocketchat_id and self.user_dns_by_rocketchat_id.get(rocketchat_id) == dn:
+                del self.user_dns_by_rocketchat_id[rocketchat_id]
+            if uid and self.user_dns_by_uid.get(uid) == dn:
+                del self.user_dns_by_uid[uid]
+
+    def complete_user_dn(self, dn):
+        if self.ldap_base_dn not in dn:
+            dn = ",".join([dn, self.ldap_users_basedn])
+        return dn
+
+    def has_user(self, dn):
+        return self.complete_user_dn(dn) in self.all_users
+
+    def add_or_update_user(self, dn, user_attributes, user_objectclasses=None, unchanged_attributes=()):
         if not dn:
             return
         if user_objectclasses is None:
             user_objectclasses = self.ldap_users_objectclasses
-        if self.ldap_base_dn not in dn:
-            dn = ",".join([dn, self.ldap_users_basedn])
+        dn = self.complete_user_dn(dn)
 
         if dn not in self.all_users.keys():
             # Create LDAP Entry
-            if self.ldap_connection.add(dn, object_class=user_objectclasses, attributes=user_attributes):
+            if self._add(dn, user_objectclasses, user_attributes):
                 logger.info(f'    Created RC user "{user_attributes.get("uid")}" in LDAP')
-                self.all_users[dn] = user_attributes
+                user = {'dn': dn, 'attributes': self._snapshot_attributes(user_attributes, user_objectclasses)}
+                with self._users_lock:
+                    self.all_users[dn] = user
+                    self._add_to_snapshots(dn, user)
+                    self._index_user(dn, user_attributes)
+                return 'created'
             else:
                 logger.error(f'    Could not create RC user "{user_attributes.get("uid")}" in LDAP')
+                return 'failed'
         else:
-            # Update LDAP Entry. Replace only on changes
+            # Update LDAP Entry. Replace only on changes, unchanged_attributes are known to be in sync already
             changes = {}
             current_ldap_user_attributes = self.all_users[dn].get('attributes', {})
             for attribute_name, current_attribute_value in current_ldap_user_attributes.items():
-                if attribute_name in user_attributes and user_attributes.get(attribute_name) != current_attribute_value:
+                if attribute_name in unchanged_attributes:
+                    continue
+                if attribute_name in user_attributes and \
+                        _normalized_values(user_attributes.get(attribute_name)) != \
+                        _normalized_values(current_attribute_value):
                     changes[attribute_name] = [(ldap3.MODIFY_REPLACE, user_attributes.get(attribute_name))]
 
-            if current_ldap_user_attributes.get('objectClass') != user_objectclasses:
+            lazy_attribute_names = [attribute_name for attribute_name in self.LAZY_USER_ATTRIBUTES
+                                    if attribute_name in user_attributes and attribute_name not in unchanged_attributes]
+            if lazy_attribute_names:
+                current_lazy_attributes = self._get_lazy_user_attributes(dn)
+                for attribute_name in lazy_attribute_names:
+                    new_value = user_attributes.get(attribute_name)
+                    if _normalized_values(new_value) != \
+                            _normalized_values(current_lazy_attributes.get(attribute_name.lower())):
+                        changes[attribute_name] = [(ldap3.MODIFY_REPLACE, new_value)]
+
+            # Neither order nor case of the objectClasses matter
+            if {objectclass.lower() for objectclass in _as_list(current_ldap_user_attributes.get('objectClass'))} != \
+                    {objectclass.lower() for objectclass in user_objectclasses}:
                 changes['objectClass'] = [(ldap3.MODIFY_REPLACE, user_objectclasses)]
 
-            if changes:
-                self.ldap_connection.modify(dn, changes, False)
-                logger.info(f'    Updated RC user "{dn}" in LDAP')
+            if not changes:
+                return 'unchanged'
 
-    def delete_users_not_in_rc(self, all_ldap_users, all_rc_users):
-        all_rc_users_uids = [user.get('username') for user in all_rc_users]
+            if not self._modify(dn, changes):
+                logger.error(f'    Could not update RC user "{dn}" in LDAP')
+                return 'failed'
 
-        for ldap_user in all_ldap_users.values():
-            ldap_uid = ldap_user.get('attributes', {}).get('uid', [''])[0]
-            if ldap_uid not in all_rc_users_uids:
-                self.delete_dn(ldap_user.get("dn"))
+            with self._users_lock:
+                current_ldap_user_attributes.update(self._snapshot_attributes(user_attributes, user_objectclasses))
+                self._index_user(dn, current_ldap_user_attributes)
+            logger.info(f'    Updated RC user "{dn}" in LDAP')
+            return 'updated'
+
+    def _snapshot_attributes(self, user_attributes, user_objectclasses):
+        attributes = {attribute_name: value for attribute_name, value in user_attributes.items()
+                      if attribute_name in self.USER_ATTRIBUTES}
+        attributes['objectClass'] = user_objectclasses
+        return attributes
+
+    def delete_users_not_in_rc(self, all_ldap_users, rc_usernames, max_deletes=None):
+        # Returns (deleted, refused): the number of deleted users, and of the users that were not deleted because
+        # there were more than max_deletes of them
+        rc_usernames = set(rc_usernames)
+        stale_dns = sorted(dn for dn, ldap_user in all_ldap_users.items()
+                           if _first_value(ldap_user.get('attributes', {}).get('uid')) not in rc_usernames)
+
+        if max_deletes is not None and len(stale_dns) > max_deletes:
+            logger.error(f'Not deleting {len(stale_dns)} LDAP users missing in Rocket.Chat, more than the maximum '
+                         f'of {max_deletes}! Raise the maximum if this is intended.')
+            metrics.inc('ldap_deletes_refused_total')
+            return 0, len(stale_dns)
+
+        deleted = 0
+        for i in range(0, len(stale_dns), self.DELETE_BATCH_SIZE):
+            if i and self.plan is None:
+                time.sleep(self.DELETE_BATCH_PAUSE_SECONDS)
+            for dn in stale_dns[i:i + self.DELETE_BATCH_SIZE]:
+                if self.delete_dn(dn):
+                    deleted += 1
+        return deleted, 0
 
     def delete_dn(self, dn):
-        if self.ldap_connection.delete(dn):
+        if self._delete(dn):
             logger.info(f'Deleted from LDAP: {dn}')
+            with self._users_lock:
+                self.all_users.pop(dn, None)
+                self._remove_from_snapshots(dn)
+                self._unindex_user(dn)
             return True
         else:
             logger.error(f'Could not delete {dn}!')
 
     def add_rc_user_to_ldap_group(self, ldap_group, ldap_group_members, rc_username):
-        rc_user_dn = f"uid={rc_username},{self.ldap_users_basedn}"
-        if rc_user_dn not in self.all_users.keys():
+        rc_user_dn = self.get_user_dn_by_uid(rc_username)
+        if rc_user_dn is None:
             # Skip bots, ignored users and everyone not synced from RC beforehand
             return
 
-        if rc_username not in ldap_group_members:
-            ret = self.ldap_connection.modify(f"{ldap_group},{self.ldap_groups_basedn}",
-                                              {'member': [(ldap3.MODIFY_ADD, [rc_user_dn])]})
+        if normalize_dn(rc_user_dn) not in {normalize_dn(dn) for dn in ldap_group_members}:
+            ret = self._modify(f"{ldap_group},{self.ldap_groups_basedn}",
+                               {'member': [(ldap3.MODIFY_ADD, [rc_user_dn])]})
             if ret:
                 logger.info(f'    Added RC user {rc_username}')
             else:
                 logger.error(f'      Could not add RC user {rc_username}!')
 
     def remove_users_from_ldap_group(self, ldap_group, rc_channel_members):
-        rc_usernames = [rc_member.get('username') for rc_member in rc_channel_members]
-        for ldap_member in rc_usernames:
-            if ldap_member not in rc_usernames:
-                ldap_user_dn = f"uid={ldap_member},{self.ldap_users_basedn}"
-                ret = self.ldap_connection.modify(f"{ldap_group},{self.ldap_groups_basedn}",
-                                                  {'member': [(ldap3.MODIFY_DELETE, [ldap_user_dn])]})
-                if ret:
-                    logger.info(f'    Removed LDAP user {ldap_member}')
-                else:
-                    logger.error(f'      Could not remove LDAP user {ldap_member}!')
+        # Only member is changed, memberUid values are left alone
+        members = self.get_group_members(ldap_group)
+        ldap_group_members = members[0] if members is not None else None
+        if not ldap_group_members:
+            return
+
+        rc_usernames = {rc_member.get('username').lower() for rc_member in rc_channel_members}
+        to_delete = [dn for dn in ldap_group_members
+                     if dn.split('=', 1)[1].split(',')[0].strip().lower() not in rc_usernames]
+        if not to_delete:
+            return
+
+        if self._modify_members(f"{ldap_group},{self.ldap_groups_basedn}", ldap3.MODIFY_DELETE, to_delete):
+            logger.info(f'    Removed LDAP users {to_delete}')
+        else:
+            logger.error(f'      Could not remove LDAP users {to_delete}!')
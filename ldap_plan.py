@@ -0,0 +1,236 @@
+import base64
+import collections
+import json
+import logging
+import threading
+import time
+
+import ldap3
+from ldap3.core.exceptions import LDAPBindError, LDAPCommunicationError, LDAPException, LDAPResponseTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+def _to_json_value(value):
+    if isinstance(value, bytes):
+        return {'base64': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_json_value(item) for key, item in value.items()}
+    return value
+
+
+class LDAPOperation:
+    ADD = 'add'
+    MODIFY = 'modify'
+    DELETE = 'delete'
+
+    def __init__(self, operation, dn, object_class=None, attributes=None, changes=None):
+        self.operation = operation
+        self.dn = dn
+        self.object_class = object_class
+        self.attributes = attributes
+        self.changes = changes
+
+    def merged_value_count(self, attribute_name, attribute_changes):
+        # Number of values of that attribute the modify would carry after merging the changes
+        if any(change[0] == ldap3.MODIFY_REPLACE for change in attribute_changes):
+            merged = list(attribute_changes)
+        else:
+            merged = self.changes.get(attribute_name, []) + list(attribute_changes)
+        return sum(len(change[1]) if isinstance(change[1], (list, tuple)) else 1 for change in merged)
+
+    def merge_changes(self, changes):
+        for attribute_name, attribute_changes in changes.items():
+            if any(change[0] == ldap3.MODIFY_REPLACE for change in attribute_changes):
+                # A later replace makes all earlier changes of that attribute irrelevant
+                self.changes[attribute_name] = list(attribute_changes)
+            else:
+                self.changes.setdefault(attribute_name, []).extend(attribute_changes)
+
+    def to_dict(self):
+        operation = {'operation': self.operation, 'dn': self.dn}
+        if self.operation == self.ADD:
+            operation.update(object_class=self.object_class, attributes=_to_json_value(self.attributes))
+        elif self.operation == self.MODIFY:
+            operation['changes'] = {attribute_name: [{'operation': change[0], 'values': _to_json_value(change[1])}
+                                                     for change in attribute_changes]
+                                    for attribute_name, attribute_changes in self.changes.items()}
+        return operation
+
+
+class ChangePlan:
+    def __init__(self, max_values=None):
+        # Values of one attribute per modify, e.g. members are changed in chunks. Larger merges are sent as
+        # separate modifies.
+        self.max_values = max_values
+        self.operations = []
+        self._operations_by_dn = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, dn, object_class, attributes):
+        with self._lock:
+            self._append(LDAPOperation(LDAPOperation.ADD, dn, object_class=object_class, attributes=attributes))
+
+    def modify(self, dn, changes):
+        with self._lock:
+            previous = self._operations_by_dn[dn.lower()]
+            if previous and previous[-1].operation == LDAPOperation.MODIFY and \
+                    self._fits(previous[-1], changes):
+                previous[-1].merge_changes(changes)
+                return
+            self._append(LDAPOperation(LDAPOperation.MODIFY, dn, changes=dict(changes)))
+
+    def _fits(self, operation, changes):
+        return self.max_values is None or all(
+            operation.merged_value_count(attribute_name, attribute_changes) <= self.max_values
+            for attribute_name, attribute_changes in changes.items())
+
+    def delete(self, dn):
+        with self._lock:
+            previous = self._operations_by_dn[dn.lower()]
+            # Deleted anyway, so earlier changes of the entry do not have to be sent
+            added_in_plan = False
+            for operation in [operation for operation in previous if operation.operation != LDAPOperation.DELETE]:
+                added_in_plan = added_in_plan or operation.operation == LDAPOperation.ADD
+                self.operations.remove(operation)
+                previous.remove(operation)
+
+            # An entry added by this plan did not exist before, unless it was deleted first
+            if not previous and not added_in_plan:
+                self._append(LDAPOperation(LDAPOperation.DELETE, dn))
+
+    def _append(self, operation):
+        self.operations.append(operation)
+        self._operations_by_dn[operation.dn.lower()].append(operation)
+
+    def phases(self):
+        # Deletes first, so deleted and re-added entries work. Adds before modifies of the same entry.
+        for operation_type in (LDAPOperation.DELETE, LDAPOperation.ADD):
+            yield [operation for operation in self.operations if operation.operation == operation_type]
+
+        # Modifies that were too large to merge are applied one after another, a phase each
+        modify_phases = collections.defaultdict(list)
+        modifies_per_dn = collections.Counter()
+        for operation in self.operations:
+            if operation.operation == LDAPOperation.MODIFY:
+                modify_phases[modifies_per_dn[operation.dn.lower()]].append(operation)
+                modifies_per_dn[operation.dn.lower()] += 1
+        for phase in sorted(modify_phases) or [0]:
+            yield modify_phases[phase]
+
+    def to_json(self):
+        return json.dumps([operation.to_dict() for operation in self.operations], indent=2)
+
+
+class PlanExecutor:
+    # Outstanding operations per executor, spread over the connections
+    WINDOW_SIZE = 64
+    # Servers and firewalls drop idle connections without the client noticing, so those are opened again
+    IDLE_SECONDS = 300
+    NOT_SENT = 'not sent'
+    CONNECTION_LOST = 'connection lost'
+    # Results of an operation sent again whose first attempt may have been applied without a response
+    ALREADY_APPLIED = {LDAPOperation.ADD: {'entryAlreadyExists'}, LDAPOperation.DELETE: {'noSuchObject'},
+                       LDAPOperation.MODIFY: {'attributeOrValueExists', 'noSuchAttribute'}}
+
+    def __init__(self, ldap_server, binddn, password, connections=1, client_strategy=ldap3.ASYNC):
+        self.ldap_server = ldap_server
+        self.binddn = binddn
+        self.password = password
+        self.client_strategy = client_strategy
+        self.connections = [self._connect() for _ in range(max(connections, 1))]
+        self.last_used = time.monotonic()
+
+    def _connect(self):
+        connection = ldap3.Connection(self.ldap_server, user=self.binddn, password=self.password,
+                                      client_strategy=self.client_strategy)
+        if not connection.bind():
+            logger.error('Could not bind to LDAP! Invalid credentials? Wrong host?')
+            raise LDAPBindError(f'Could not bind to LDAP as {self.binddn}: {connection.result}')
+        return connection
+
+    def _reconnect(self, force=False):
+        # Connections that were closed, idle for too long or just lost an operation are opened again
+        idle = time.monotonic() - self.last_used > self.IDLE_SECONDS
+        for i, connection in enumerate(self.connections):
+            if force or idle or connection.closed or not connection.bound:
+                logger.debug('Opening LDAP write connection again')
+                try:
+                    connection.unbind()
+                except LDAPException:
+                    pass
+                self.connections[i] = self._connect()
+
+    def apply(self, plan):
+        # Returns (operation, success, result description) for every operation, in plan order of each phase
+        results = []
+        for operations in plan.phases():
+            self._reconnect()
+            phase_results = self._apply_phase(operations)
+
+            # Operations that were not sent or lost their connection are sent once more over fresh connections
+            lost = [operation for operation, _, description in phase_results
+                    if description in (self.NOT_SENT, self.CONNECTION_LOST)]
+            if lost:
+                logger.warning(f'Lost the LDAP connection for {len(lost)} operations, sending them again')
+                self._reconnect(force=True)
+                retried = iter(self._apply_phase(lost, retry=True))
+                phase_results = [next(retried) if description in (self.NOT_SENT, self.CONNECTION_LOST)
+                                 else (operation, success, description)
+                                 for operation, success, description in phase_results]
+            results.extend(phase_results)
+            self.last_used = time.monotonic()
+        return results
+
+    def _apply_phase(self, operations, retry=False):
+        results = []
+        pending = collections.deque()
+        for i, operation in enumerate(operations):
+            connection = self.connections[i % len(self.connections)]
+            pending.append((operation, connection, self._send(connection, operation), retry))
+            if len(pending) >= self.WINDOW_SIZE:
+                results.append(self._receive(*pending.popleft()))
+
+        while pending:
+            results.append(self._receive(*pending.popleft()))
+        return results
+
+    @staticmethod
+    def _send(connection, operation):
+        try:
+            if operation.operation == LDAPOperation.ADD:
+                return connection.add(operation.dn, object_class=operation.object_class,
+                                      attributes=operation.attributes)
+            if operation.operation == LDAPOperation.MODIFY:
+                return connection.modify(operation.dn, operation.changes)
+            return connection.delete(operation.dn)
+        except LDAPException as exc:
+            logger.error(f'Could not send {operation.operation} of {operation.dn}: {exc}')
+            return None
+
+    @classmethod
+    def _receive(cls, operation, connection, message_id, retry=False):
+        if not message_id:
+            return operation, False, cls.NOT_SENT
+
+        try:
+            _, result = connection.get_response(message_id)
+        except (LDAPCommunicationError, LDAPResponseTimeoutError) as exc:
+            logger.debug(f'No response for {operation.operation} of {operation.dn}: {exc}')
+            return operation, False, cls.CONNECTION_LOST
+        except LDAPException as exc:
+            return operation, False, str(exc)
+
+        description = result.get('description')
+        if retry and description in cls.ALREADY_APPLIED[operation.operation]:
+            return operation, True, f'{description}, applied before the connection was lost'
+        return operation, result.get('result') == 0, description
+
+    def close(self):
+        for connection in self.connections:
+            connection.unbind()
@@ -0,0 +1,181 @@
+import contextlib
+import functools
+import http.server
+import inspect
+import os
+import threading
+import time
+
+# Seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels_key, extra=()):
+    labels = list(labels_key) + list(extra)
+    if not labels:
+        return ''
+    escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metrics:
+    # Cumulative counters and latency histograms for the whole process. A cycle summary is the difference to the
+    # values at the start of the cycle.
+    PREFIX = 'rc_sync_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self._cycle_start = ({}, {})
+        self._cycle_started_at = None
+        self.exposition = ''
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bucket in enumerate(BUCKETS):
+                if seconds <= bucket:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        # Decorator, generator functions are timed until they are exhausted
+        def decorator(func):
+            if inspect.isgeneratorfunction(func):
+                @functools.wraps(func)
+                def timed_generator(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        yield from func(*args, **kwargs)
+                return timed_generator
+
+            @functools.wraps(func)
+            def timed_func(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return timed_func
+        return decorator
+
+    def start_cycle(self):
+        with self._lock:
+            self._cycle_start = (dict(self.counters),
+                                 {key: [list(value[0]), value[1], value[2]] for key, value in self.histograms.items()})
+            self._cycle_started_at = time.time()
+
+    def end_cycle(self):
+        # Returns the summary of the cycle and updates the Prometheus exposition
+        with self._lock:
+            start_counters, start_histograms = self._cycle_start
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                value -= start_counters.get((name, labels), 0)
+                if value:
+                    counters.setdefault(name, {})[_format_labels(labels) or 'total'] = value
+
+            timings = {}
+            for (name, labels), (_, total, count) in self.histograms.items():
+                _, start_total, start_count = start_histograms.get((name, labels), (None, 0.0, 0))
+                if count - start_count:
+                    timings.setdefault(name, {})[_format_labels(labels) or 'total'] = {
+                        'count': count - start_count, 'seconds': round(total - start_total, 4)}
+
+            summary = {'cycle_started_at': self._cycle_started_at,
+                       'cycle_seconds': round(time.time() - (self._cycle_started_at or time.time()), 4),
+                       'counters': counters, 'timings': timings}
+
+        self.exposition = self.to_prometheus()
+        return summary
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {self.PREFIX}{name} counter')
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{self.PREFIX}{name}{_format_labels(labels)} {value}')
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {self.PREFIX}{name} histogram')
+                for (histogram_name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bucket, bucket_count in zip(BUCKETS, buckets):
+                        lines.append(f'{self.PREFIX}{name}_bucket{_format_labels(labels, [("le", str(bucket))])} '
+                                     f'{bucket_count}')
+                    lines.append(f'{self.PREFIX}{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+                    lines.append(f'{self.PREFIX}{name}_sum{_format_labels(labels)} {total}')
+                    lines.append(f'{self.PREFIX}{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # Written atomically, for the node_exporter textfile collector
+        with open(path + '.tmp', 'w') as textfile:
+            textfile.write(self.exposition)
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port):
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.exposition.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def merge_summaries(summaries):
+    # One summary of several processes, e.g. the shards of a run
+    merged = {'cycle_started_at': None, 'cycle_seconds': 0, 'counters': {}, 'timings': {}}
+    for summary in summaries:
+        if summary.get('cycle_started_at') is not None:
+            merged['cycle_started_at'] = min(filter(None, [merged['cycle_started_at'],
+                                                           summary.get('cycle_started_at')]))
+        merged['cycle_seconds'] = max(merged['cycle_seconds'], summary.get('cycle_seconds', 0))
+
+        for name, values in summary.get('counters', {}).items():
+            counters = merged['counters'].setdefault(name, {})
+            for labels, value in values.items():
+                counters[labels] = counters.get(labels, 0) + value
+
+        for name, values in summary.get('timings', {}).items():
+            timings = merged['timings'].setdefault(name, {})
+            for labels, timing in values.items():
+                merged_timing = timings.setdefault(labels, {'count': 0, 'seconds': 0})
+                merged_timing['count'] += timing.get('count', 0)
+                merged_timing['seconds'] = round(merged_timing['seconds'] + timing.get('seconds', 0), 4)
+    return merged
+
+
+metrics = Metrics()
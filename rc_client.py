@@ -1,47 +1,200 @@
-from requests import Session
+from requests.adapters import HTTPAdapter
 from rocketchat_API.rocketchat import RocketChat
 from packaging import version
+from urllib.parse import urlsplit
+import json
 import logging
 import pymongo
+import threading
+import time
+
+from avatar_cache import AvatarCache
+from metrics import metrics
+from rc_session import RateLimitedSession
+from sync_state import parse_timestamp
+from ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
 
 class RCUser:
-    def __init__(self, rc_full_details):
-        self.raw = rc_full_details
+    # Only the fields the sync uses, the full document (login tokens, settings, ...) is not kept
+    __slots__ = ('username', 'rocketchat_id', 'name', 'mail', 'password_hash', 'custom_fields', 'roles',
+                 'avatar_origin', 'avatar_etag', 'updated_at')
 
+    def __init__(self, rc_full_details):
         self.username = rc_full_details.get("username")
         self.rocketchat_id = rc_full_details.get("_id")
         self.name = rc_full_details.get("name")
         self.mail = rc_full_details.get('emails', [{}])[0].get('address', None)
         self.password_hash = rc_full_details.get('services', {}).get('password', {}).get('bcrypt')
         self.custom_fields = rc_full_details.get("customFields", {})
-        self.roles = rc_full_details.get("roles", [])
+        self.roles = tuple(rc_full_details.get("roles", []))
+        self.avatar_origin = rc_full_details.get("avatarOrigin")
+        self.avatar_etag = rc_full_details.get("avatarETag")
+        self.updated_at = parse_timestamp(rc_full_details.get("_updatedAt"))
 
         if not self.password_hash:
             logger.error(f"Cannot get password for {self.username}! Not an admin user or no password available!")
 
+    @property
+    def avatar_version(self):
+        # Rocket.Chat sets a new avatarETag whenever the avatar changes
+        if self.avatar_etag is None:
+            return None
+        return f'{self.avatar_origin}:{self.avatar_etag}'
+
 
 class RocketChatMongoClient:
-    def __init__(self, mongo_host="mongo", mongo_user="", mongo_pass=""):
-        mongo_cli = pymongo.MongoClient(mongo_host)
+    # Only the fields RCUser reads, so login tokens and settings stay in the database
+    USER_PROJECTION = {"username": 1, "name": 1, "emails": 1, "services.password.bcrypt": 1, "customFields": 1,
+                       "roles": 1, "avatarOrigin": 1, "avatarETag": 1, "_updatedAt": 1}
+
+    # Changes relevant for the sync. Updates of subscriptions (unread counters) and rooms (last message) are
+    # frequent, joins are subscription inserts and leaves show up as an update of the rooms usersCount.
+    CHANGE_STREAM_PIPELINE = [{"$match": {"$or": [
+        {"ns.coll": "rocketchat_subscription", "operationType": "insert"},
+        {"ns.coll": "rocketchat_room", "operationType": {"$in": ["insert", "replace"]}},
+        {"ns.coll": "rocketchat_room", "operationType": "update",
+         "updateDescription.updatedFields.usersCount": {"$exists": True}},
+        {"ns.coll": "users"},
+    ]}}]
+    # Presence and login updates of users are ignored
+    WATCHED_USER_FIELDS = ("username", "name", "emails", "services.password", "customFields", "roles",
+                           "avatarOrigin", "avatarETag")
+
+    def __init__(self, mongo_host="mongo", mongo_user="", mongo_pass="", batch_size=1000, mongo_cli=None):
+        if mongo_cli is None:
+            mongo_cli = pymongo.MongoClient(mongo_host)
         self.mongo_db = mongo_cli.get_database("rocketchat")
+        self.batch_size = batch_size
 
+    @metrics.timed('mongo_query_seconds', operation='get_rc_user')
     def get_rc_user(self, username):
         users = self.mongo_db.get_collection("users")
 
-        cursor = users.find({"username": username})
+        user = users.find_one({"username": username}, projection=self.USER_PROJECTION)
+        if user is None:
+            logger.error(f'Could not find user {username} in MongoDB')
+            return
+
+        return RCUser(user)
 
-        return RCUser(list(cursor)[0])
+    @metrics.timed('mongo_query_seconds', operation='get_rc_users')
+    def get_rc_users(self, usernames=None):
+        users = self.mongo_db.get_collection("users")
+
+        if usernames is None:
+            for user in users.find({"username": {"$exists": True}}, projection=self.USER_PROJECTION,
+                                   batch_size=self.batch_size):
+                yield RCUser(user)
+            return
+
+        usernames = list(usernames)
+        for i in range(0, len(usernames), self.batch_size):
+            cursor = users.find({"username": {"$in": usernames[i:i + self.batch_size]}},
+                                projection=self.USER_PROJECTION)
+            for user in cursor:
+                yield RCUser(user)
+
+    @metrics.timed('mongo_query_seconds', operation='get_rc_usernames')
+    def get_rc_usernames(self):
+        users = self.mongo_db.get_collection("users")
+
+        return {user.get("username") for user in users.find({"username": {"$exists": True}},
+                                                            projection={"username": 1}, batch_size=self.batch_size)}
+
+    @metrics.timed('mongo_query_seconds', operation='get_rc_users_by_ids')
+    def get_rc_users_by_ids(self, rocketchat_ids):
+        users = self.mongo_db.get_collection("users")
+
+        rocketchat_ids = list(rocketchat_ids)
+        for i in range(0, len(rocketchat_ids), self.batch_size):
+            cursor = users.find({"_id": {"$in": rocketchat_ids[i:i + self.batch_size]}, "username": {"$exists": True}},
+                                projection=self.USER_PROJECTION)
+            for user in cursor:
+                yield RCUser(user)
+
+    @metrics.timed('mongo_query_seconds', operation='get_rc_users_updated_since')
+    def get_rc_users_updated_since(self, since):
+        users = self.mongo_db.get_collection("users")
+
+        for user in users.find({"username": {"$exists": True}, "_updatedAt": {"$gt": since}},
+                               projection=self.USER_PROJECTION, batch_size=self.batch_size):
+            yield RCUser(user)
+
+    @metrics.timed('mongo_query_seconds', operation='get_rooms_updated_since')
+    def get_rooms_updated_since(self, since, room_names):
+        # Membership changes touch the subscription, leaving a room also updates the rooms usersCount
+        room_names = list(room_names)
+        updated_rooms, watermark = set(), since
+        for collection, name_field in (("rocketchat_room", "name"), ("rocketchat_subscription", "name")):
+            cursor = self.mongo_db.get_collection(collection).find(
+                {name_field: {"$in": room_names}, "_updatedAt": {"$gt": since}},
+                projection={name_field: 1, "_updatedAt": 1})
+            for document in cursor:
+                updated_rooms.add(document.get(name_field))
+                watermark = max(watermark, document.get("_updatedAt"))
+
+        return updated_rooms, watermark
+
+    @metrics.timed('mongo_query_seconds', operation='get_rooms_members')
+    def get_rooms_members(self, room_names):
+        # Subscriptions carry the room name and type, so all memberships come from a single aggregation
+        subscriptions = self.mongo_db.get_collection("rocketchat_subscription")
+
+        cursor = subscriptions.aggregate([
+            {"$match": {"name": {"$in": list(room_names)}, "t": {"$in": ["c", "p"]}}},
+            {"$group": {"_id": "$rid", "name": {"$first": "$name"},
+                        "members": {"$push": {"_id": "$u._id", "username": "$u.username"}}}},
+        ], allowDiskUse=True)
+
+        return {room.get("name"): room.get("members") for room in cursor}
+
+    @metrics.timed('mongo_query_seconds', operation='get_rooms')
+    def get_rooms(self):
+        rooms = self.mongo_db.get_collection("rocketchat_room")
+
+        return list(rooms.find({"t": {"$in": ["c", "p"]}}, projection={"name": 1, "t": 1}))
+
+    def watch(self, resume_token=None, max_await_time_ms=1000):
+        # Needs a replica set, a single node one is enough
+        return self.mongo_db.watch(self.CHANGE_STREAM_PIPELINE, resume_after=resume_token,
+                                   max_await_time_ms=max_await_time_ms)
+
+    @classmethod
+    def parse_change(cls, change):
+        # Returns (kind, id, name) with kind "room", "user" or "user_deleted", or None for irrelevant changes
+        collection = change.get("ns", {}).get("coll")
+        document = change.get("fullDocument") or {}
+        document_id = change.get("documentKey", {}).get("_id")
+
+        if collection == "rocketchat_subscription":
+            return "room", document.get("rid"), document.get("name")
+        if collection == "rocketchat_room":
+            return "room", document_id, document.get("name")
+        if collection == "users":
+            if change.get("operationType") == "delete":
+                return "user_deleted", document_id, None
+            if change.get("operationType") == "update":
+                updated_fields = change.get("updateDescription", {}).get("updatedFields", {})
+                if not any(field == watched or field.startswith(watched + ".")
+                           for field in updated_fields for watched in cls.WATCHED_USER_FIELDS):
+                    return None
+            return "user", document_id, document.get("username")
+        return None
 
 
 class RocketChatClient:
     USE_MONGODB = True
+    ROOM_DIRECTORY_TTL = 300
+    # Default for user_cache_ttl
+    USER_CACHE_TTL = 3600
+    INVITE_BATCH_SIZE = 50
 
     def __init__(self, username, password, host="http://rocketchat:3000", ignore_users=None, custom_user_field=None,
                  custom_user_field_conversions=None, log_level=logging.INFO,
-                 mongo=None):
+                 mongo=None, avatar_cache_dir=None, session=None, user_cache_ttl=None, warm_start=None):
         self.username = username
         self.password = password
         self.host = host
@@ -50,28 +203,96 @@ class RocketChatClient:
         self.ignore_users = ignore_users if ignore_users is not None else []
         logger.setLevel(log_level)
 
-        self.session = Session()
+        self.session = session if session is not None else RateLimitedSession()
+        self.session.hooks['response'].append(self._record_response)
         self.rocket = RocketChat(self.username, self.password, server_url=self.host, session=self.session)
 
-        info_req = self.rocket.info()
-        if info_req.ok:
-            if version.parse(info_req.json().get("info").get("version")) < version.parse("3.4"):
-                self.USE_MONGODB = False
+        self.rc_version = warm_start.rc_version if warm_start is not None else None
+        if self.rc_version is None:
+            info_req = self.rocket.info()
+            if info_req.ok:
+                self.rc_version = info_req.json().get("info").get("version")
+        if self.rc_version is not None and version.parse(self.rc_version) < version.parse("3.4"):
+            self.USE_MONGODB = False
 
         self.mongo = mongo
+        self.avatar_cache = AvatarCache(avatar_cache_dir) if avatar_cache_dir else None
+
+        # Expired between runs, so a long running sync picks up changed users
+        self.known_rc_users = TTLCache(user_cache_ttl if user_cache_ttl is not None else self.USER_CACHE_TTL)
+        self.rc_channel_members = {}
+
+        # room name -> (room id, room type), so resolving rooms does not cost channels.info/groups.info every time
+        self.room_directory = {}
+        self.room_directory_loaded_at = None
+        if warm_start is not None and warm_start.room_directory:
+            # Still reloaded once it is older than the TTL
+            self.room_directory = warm_start.room_directory
+            self.room_directory_loaded_at = time.monotonic() - warm_start.age
+        self._room_directory_lock = threading.Lock()
+        self.me_id = None
+
+    @staticmethod
+    def _record_response(response, *args, **kwargs):
+        endpoint = urlsplit(response.request.url).path.rsplit('/', 1)[-1]
+        metrics.inc('rest_requests_total', endpoint=endpoint, status=response.status_code)
+        metrics.observe('rest_request_seconds', response.elapsed.total_seconds(), endpoint=endpoint)
+
+    def set_pool_size(self, pool_size):
+        if isinstance(self.session, RateLimitedSession):
+            self.session.set_pool_size(pool_size)
+            return
 
-        self.known_rc_users = {}
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    def get_channel_id(self, rc_channel):
-        _channel = self.rocket.channels_info(channel=rc_channel)
-        if _channel.json().get('success'):
-            _channel = _channel.json().get('channel')
-            return _channel.get('_id')
+    def _load_room_directory(self):
+        if self.USE_MONGODB:
+            rooms = self.mongo.get_rooms()
+        else:
+            fields = json.dumps({"name": 1, "t": 1})
+            rooms = (self._get_all_pages(self.rocket.channels_list, 'channels', fields=fields) or []) + \
+                    (self._get_all_pages(self.rocket.groups_list_all, 'groups', fields=fields) or [])
+
+        self.room_directory = {room.get('name'): (room.get('_id'), room.get('t')) for room in rooms}
+        self.room_directory_loaded_at = time.monotonic()
+        logger.debug(f'Loaded {len(self.room_directory)} rooms into the room directory')
+
+    def get_room(self, rc_channel):
+        with self._room_directory_lock:
+            if self.room_directory_loaded_at is None or \
+                    time.monotonic() - self.room_directory_loaded_at > self.ROOM_DIRECTORY_TTL:
+                self._load_room_directory()
+
+            if rc_channel in self.room_directory:
+                return self.room_directory.get(rc_channel)
+
+        # Created after the directory was loaded?
+        channel_response = self.rocket.channels_info(channel=rc_channel)
+        _channel = channel_response.json()
+        if _channel.get('success'):
+            room = (_channel.get('channel').get('_id'), 'c')
         else:
+            if channel_response.status_code == 429:
+                logger.error(f'Could not look up channel "#{rc_channel}", still rate limited after retrying')
+                return None
             logger.debug(f' Channel "#{rc_channel}" is probably private, so checking groups...')
-            group_info = self.rocket.groups_info(room_name=rc_channel).json()
-            if group_info.get('success'):
-                return group_info.get('group').get('_id')
+            group_response = self.rocket.groups_info(room_name=rc_channel)
+            group_info = group_response.json()
+            if not group_info.get('success'):
+                if group_response.status_code == 429:
+                    logger.error(f'Could not look up group "#{rc_channel}", still rate limited after retrying')
+                return None
+            room = (group_info.get('group').get('_id'), 'p')
+
+        self.room_directory[rc_channel] = room
+        return room
+
+    def get_channel_id(self, rc_channel):
+        room = self.get_room(rc_channel)
+        if room is not None:
+            return room[0]
 
         logger.info(f'Channel "#{rc_channel}" in the config is not found on the Rocket.Chat instance! '
                     f'Misconfiguration? Channel renamed?')
@@ -83,32 +304,55 @@ class RocketChatClient:
                 rc_user.username in self.ignore_users or
                 not rc_user.password_hash)
 
+    @staticmethod
+    def _get_all_pages(api_call, key, require_complete=False, **kwargs):
+        # With require_complete, None is returned instead of the pages gotten so far if a page fails
+        response = api_call(**kwargs).json()
+        if not response.get('success'):
+            return None
+
+        items = response.get(key, [])
+        while response.get('count') and response.get('total', 0) > len(items):
+            response = api_call(offset=len(items), **kwargs).json()
+            if not response.get('success'):
+                logger.error(f'Could not get all {key}, stopping at {len(items)}/{response.get("total")}')
+                if require_complete:
+                    return None
+                break
+            items.extend(response.get(key, []))
+
+        return items
+
     def get_group_members_admin_workaround(self, rc_channelname):
         # https://github.com/RocketChat/Rocket.Chat/issues/15435
-        all_groups = self.rocket.groups_list_all().json().get('groups', [])
-        groups = list(filter(lambda g: g.get('name') == rc_channelname, all_groups))
-        if not groups:
+        room = self.get_room(rc_channelname)
+        if room is None:
             return None
 
-        group = groups[0]
-        me = self.rocket.me().json()
-        if not self.rocket.groups_invite(room_id=group.get('_id'), user_id=me.get('_id')).json().get('success'):
+        room_id = room[0]
+        if self.me_id is None:
+            self.me_id = self.rocket.me().json().get('_id')
+        if not self.rocket.groups_invite(room_id=room_id, user_id=self.me_id).json().get('success'):
             return []
 
-        members_ret = self.rocket.groups_members(room_id=group.get('_id')).json()
-        if not members_ret.get('success'):
+        members = self._get_all_pages(self.rocket.groups_members, 'members', room_id=room_id)
+        if members is None:
             return []
 
-        return members_ret.get('members')
+        return members
 
     def add_group(self, group_name):
         response = self.rocket.groups_create(group_name).json()
+        if response.get("success"):
+            self.room_directory[group_name] = (response.get("group").get("_id"), 'p')
         return response.get("success") or response.get("errorType") == "error-duplicate-channel-name"
 
     def get_rc_user(self, user):
         username = user.get('username') if type(user) is dict else user
         if username in self.known_rc_users:
+            metrics.inc('rc_user_cache_total', result='hit')
             return self.known_rc_users.get(username)
+        metrics.inc('rc_user_cache_total', result='miss')
 
         if self.USE_MONGODB:
             rc_user = self.mongo.get_rc_user(username)
@@ -127,9 +371,56 @@ class RocketChatClient:
                 return
             rc_user = RCUser(_api.get('user'))
 
-        self.known_rc_users[rc_user.username] = rc_user
+        if rc_user is not None:
+            self.known_rc_users[rc_user.username] = rc_user
         return rc_user
 
+    def prefetch_rc_users(self, usernames=None):
+        # Fill known_rc_users in bulk, so get_rc_user does not need one query per user
+        if not self.USE_MONGODB:
+            return
+
+        if usernames is not None:
+            usernames = {username for username in usernames if username and username not in self.known_rc_users}
+            if not usernames:
+                return
+
+        for rc_user in self.mongo.get_rc_users(usernames):
+            self.known_rc_users[rc_user.username] = rc_user
+
+    def forget_rc_users(self):
+        # The next lookups read the users from Rocket.Chat again
+        self.known_rc_users.clear()
+
+    def get_rc_users_by_ids(self, rocketchat_ids):
+        # Fresh from MongoDB, replacing the cached users
+        rc_users = list(self.mongo.get_rc_users_by_ids(rocketchat_ids))
+        for rc_user in rc_users:
+            self.known_rc_users[rc_user.username] = rc_user
+        return rc_users
+
+    def get_rc_users_updated_since(self, since):
+        if self.USE_MONGODB:
+            updated_users = list(self.mongo.get_rc_users_updated_since(since))
+        else:
+            query = json.dumps({"_updatedAt": {"$gt": {"$date": since.isoformat() + "Z"}}})
+            updated_users = []
+            for user in self.get_all_users(query=query, fields=json.dumps({"username": 1})):
+                self.known_rc_users.pop(user.get('username'), None)
+                rc_user = self.get_rc_user(user)
+                if rc_user is not None:
+                    updated_users.append(rc_user)
+
+        for rc_user in updated_users:
+            self.known_rc_users[rc_user.username] = rc_user
+        return updated_users
+
+    def get_rc_channels_updated_since(self, since, rc_channels):
+        # Returns None if changes cannot be determined, so every channel has to be checked
+        if not self.USE_MONGODB:
+            return None, since
+        return self.mongo.get_rooms_updated_since(since, rc_channels)
+
     def get_dn_of_rc_user_by_custom_field(self, rc_user):
         custom_field_value = rc_user.custom_fields.get(self.custom_user_field)
         base_dn = self.custom_user_field_conversions.get(custom_field_value, None)
@@ -139,43 +430,146 @@ class RocketChatClient:
 
         return f'uid={rc_user.username},{base_dn}'
 
-    def get_user_avatar(self, user):
-        avatar = self.rocket.users_get_avatar(user_id=user.get('_id'))
+    def _download_user_avatar(self, rc_user, headers=None):
+        url = f'{self.host}/api/v1/users.getAvatar'
+        headers = dict(self.rocket.headers, **(headers or {}))
+
+        # With the timeout and TLS settings rocketchat_API uses for its own requests
+        options = {'verify': self.rocket.ssl_verify, 'cert': self.rocket.cert, 'proxies': self.rocket.proxies,
+                   'timeout': self.rocket.timeout}
+
+        avatar = self.session.get(url, params={'userId': rc_user.rocketchat_id}, headers=headers, **options)
         if avatar.status_code == 404:
-            avatar = self.rocket.users_get_avatar(username=user.get('username'))
+            avatar = self.session.get(url, params={'username': rc_user.username}, headers=headers, **options)
+
+        return avatar
+
+    def get_user_avatar(self, rc_user):
+        # Returns the avatar and whether it changed since the last time it was synced
+        if self.avatar_cache is None:
+            return self._download_user_avatar(rc_user).content, True
+
+        version = rc_user.avatar_version
+        cached = self.avatar_cache.get(rc_user.rocketchat_id)
+        if cached is not None and version is not None and cached.get('version') == version:
+            return self.avatar_cache.read(rc_user.rocketchat_id), \
+                AvatarCache.synced_digest(cached) != cached.get('digest')
+
+        headers = {}
+        if cached is not None and cached.get('etag'):
+            headers['If-None-Match'] = cached.get('etag')
+        if cached is not None and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached.get('last_modified')
+
+        avatar = self._download_user_avatar(rc_user, headers)
+        if avatar.status_code == 304 and cached is not None:
+            self.avatar_cache.touch(rc_user.rocketchat_id, version)
+            return self.avatar_cache.read(rc_user.rocketchat_id), \
+                AvatarCache.synced_digest(cached) != cached.get('digest')
+
+        content = avatar.content
+        if not avatar.ok:
+            logger.warning(f'Could not get avatar of {rc_user.username}: HTTP {avatar.status_code}')
+            return content, True
+
+        changed = cached is None or AvatarCache.synced_digest(cached) != AvatarCache.digest(content)
+        self.avatar_cache.put(rc_user.rocketchat_id, content, version=version, etag=avatar.headers.get('ETag'),
+                              last_modified=avatar.headers.get('Last-Modified'))
+        return content, changed
+
+    def get_cached_avatar_digest(self, rc_user):
+        # Digest of the current avatar if the cache holds its version, None if it has to be downloaded
+        if self.avatar_cache is None or rc_user.avatar_version is None:
+            return None
+        cached = self.avatar_cache.get(rc_user.rocketchat_id)
+        if cached is None or cached.get('version') != rc_user.avatar_version:
+            return None
+        return cached.get('digest')
 
-        return avatar.content
+    def mark_avatar_synced(self, rc_user, avatar):
+        if self.avatar_cache is not None:
+            self.avatar_cache.mark_synced(rc_user.rocketchat_id, avatar)
 
-    def get_all_users(self):
-        all_users = []
-        users_call = self.rocket.users_list().json()
-        all_users.extend(users_call.get('users', []))
+    def expire_caches(self):
+        expired = self.known_rc_users.expire()
+        if expired:
+            logger.debug(f'Expired {expired} cached RC users')
 
-        current_offset = users_call.get('count')
-        while users_call.get('total') > current_offset:
-            users_call = self.rocket.users_list(offset=current_offset).json()
-            current_offset += users_call.get('count')
-            all_users.extend(users_call.get('users', []))
+    def save_caches(self):
+        if self.avatar_cache is not None:
+            self.avatar_cache.save()
 
-        return all_users
+    def get_all_rc_usernames(self):
+        # Every user, not just the ones cached in this run. None if that cannot be determined.
+        if self.USE_MONGODB:
+            return self.mongo.get_rc_usernames()
+
+        users = self._get_all_pages(self.rocket.users_list, 'users', require_complete=True,
+                                    fields=json.dumps({"username": 1}))
+        if users is None:
+            return None
+        return {user.get('username') for user in users if user.get('username')}
+
+    def get_all_users(self, **kwargs):
+        all_users = self._get_all_pages(self.rocket.users_list, 'users', **kwargs)
+        return all_users if all_users is not None else []
 
     def add_userid_to_channel(self, user_id, rc_channel):
-        rc_channel_id = self.get_channel_id(rc_channel)
+        room = self.get_room(rc_channel)
+        if room is None:
+            return False
+
+        room_id, room_type = room
+        if room_type == 'p':
+            return self.rocket.groups_invite(room_id=room_id, user_id=user_id).json().get('success')
+        return self.rocket.channels_invite(user_id=user_id, room_id=room_id).json().get('success')
+
+    def add_userids_to_channel(self, user_ids, rc_channel):
+        # Returns the user ids which could not be added
+        room = self.get_room(rc_channel)
+        if room is None:
+            return list(user_ids)
+
+        room_id, room_type = room
+        method = 'groups.invite' if room_type == 'p' else 'channels.invite'
+        user_ids = list(user_ids)
+
+        failed = []
+        for i in range(0, len(user_ids), self.INVITE_BATCH_SIZE):
+            batch = user_ids[i:i + self.INVITE_BATCH_SIZE]
+            response = self.rocket.call_api_post(method, roomId=room_id, userIds=batch).json()
+            if response.get('success'):
+                continue
+
+            # The response does not tell which user failed, so find out one by one
+            logger.debug(f'Batch invite into "#{rc_channel}" failed ({response.get("error")}), inviting one by one')
+            failed.extend(user_id for user_id in batch if not self.add_userid_to_channel(user_id, rc_channel))
+
+        return failed
+
+    def prefetch_rc_channel_members(self, rc_channels):
+        # Replaces the members of the previous run, channels not found in MongoDB are looked up via REST
+        self.rc_channel_members = {}
+        if not self.USE_MONGODB:
+            return
 
-        return self.rocket.channels_invite(user_id=user_id, room_id=rc_channel_id).json().get('success')
+        self.rc_channel_members = self.mongo.get_rooms_members(rc_channels)
 
     def get_rc_channel_members(self, rc_channel):
-        channel_info = self.rocket.channels_info(channel=rc_channel).json()
-        if channel_info.get('success'):
-            room_id = channel_info.get('channel').get('_id')
-            return self.rocket.channels_members(room_id=room_id).json().get('members')
-        else:
-            logger.debug(f' Channel "#{rc_channel}" is probably private, so checking groups...')
-            group_info = self.rocket.groups_info(room_name=rc_channel).json()
-            if group_info.get('success'):
-                room_id = group_info.get('group').get('_id')
-                return self.rocket.groups_members(room_id=room_id).json().get('members')
-            else:
-                logger.debug(f' No member of group "#{rc_channel}", or does not exist. trying to become member...')
-                return self.get_group_members_admin_workaround(rc_channel)
+        if rc_channel in self.rc_channel_members:
+            return self.rc_channel_members.get(rc_channel)
+
+        room = self.get_room(rc_channel)
+        if room is None:
+            return None
+
+        room_id, room_type = room
+        if room_type != 'p':
+            return self._get_all_pages(self.rocket.channels_members, 'members', room_id=room_id)
+
+        members = self._get_all_pages(self.rocket.groups_members, 'members', room_id=room_id)
+        if members is None:
+            logger.debug(f' No member of group "#{rc_channel}", trying to become member...')
+            return self.get_group_members_admin_workaround(rc_channel)
+        return members
 
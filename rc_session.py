@@ -0,0 +1,118 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimit:
+    # The limit of one endpoint as announced by Rocket.Chat's X-RateLimit-* headers: a bucket of `limit` tokens,
+    # refilled when the window resets
+    MAX_WAIT_SECONDS = 120
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+
+    def reserve(self, now):
+        # Takes a token, returns how many seconds to wait first if there is none
+        if self.reset_at is not None and now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = None
+
+        if self.remaining is None:
+            return 0
+        if self.remaining > 0:
+            self.remaining -= 1
+            return 0
+        if self.reset_at is None:
+            return 0
+        return min(self.reset_at - now, self.MAX_WAIT_SECONDS)
+
+    def update(self, headers):
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+
+        self.limit = limit
+        self.remaining = remaining
+        # Rocket.Chat sends the end of the window in milliseconds since the epoch
+        self.reset_at = reset / 1000 if reset > 10 ** 11 else reset
+
+
+class RateLimitedSession(Session):
+    # Waits instead of tripping the rate limiter and retries throttled or unavailable requests with backoff
+    RETRY_STATUSES = {429, 502, 503, 504}
+    MAX_RETRIES = 5
+    BACKOFF_SECONDS = 0.5
+    MAX_BACKOFF_SECONDS = 30
+
+    def __init__(self, pool_size=10, max_retries=MAX_RETRIES):
+        super().__init__()
+        self.max_retries = max_retries
+        self.rate_limits = {}
+        self._lock = threading.Lock()
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, pool_size):
+        # Keep-alive connections for every worker, with retries of failed connects
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=None, connect=3, read=0, status=0, redirect=5,
+                                                backoff_factor=self.BACKOFF_SECONDS))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def _wait_for_token(self, endpoint):
+        while True:
+            with self._lock:
+                rate_limit = self.rate_limits.setdefault(endpoint, RateLimit())
+                wait = rate_limit.reserve(time.time())
+            if wait <= 0:
+                return rate_limit
+
+            logger.debug(f'Rate limit of {endpoint} reached, waiting {wait:.1f}s')
+            metrics.inc('rest_throttled_seconds_total', wait, endpoint=endpoint)
+            time.sleep(wait)
+
+    def _retry_delay(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), RateLimit.MAX_WAIT_SECONDS)
+
+        backoff = min(self.BACKOFF_SECONDS * 2 ** attempt, self.MAX_BACKOFF_SECONDS)
+        return random.uniform(backoff / 2, backoff)
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = urlsplit(url).path
+        for attempt in range(self.max_retries + 1):
+            rate_limit = self._wait_for_token(endpoint)
+            response = super().request(method, url, *args, **kwargs)
+            with self._lock:
+                rate_limit.update(response.headers)
+
+            if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                return response
+
+            if response.status_code == 429 and rate_limit.reset_at is not None and \
+                    'Retry-After' not in response.headers:
+                # The next attempt waits for the reset of the window anyway
+                delay = 0
+            else:
+                delay = self._retry_delay(response, attempt)
+            logger.warning(f'{method} {endpoint} returned {response.status_code}, retrying in {delay:.1f}s '
+                           f'({attempt + 1}/{self.max_retries})')
+            metrics.inc('rest_retries_total', endpoint=endpoint, status=response.status_code)
+            response.close()
+            time.sleep(delay)
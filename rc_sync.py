@@ -1,22 +1,79 @@
 #!/bin/python3
+import collections
+import contextlib
+import datetime
+import hashlib
+import json
 import ldap3
 import yaml
 import logging
+import multiprocessing
 import os
+import signal
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from avatar_cache import AvatarCache
 from rc_client import RocketChatClient, RocketChatMongoClient
-from ldap_client import LDAPClient
+from ldap_client import LDAPClient, normalize_dn
+from metrics import merge_summaries, metrics
+from rc_watch import RCLDAPWatcher
+from scheduler import Scheduler
+from sharding import GroupLocks, process_of, shard_of
+from sync_state import SyncState
+from warm_start import WarmStart
 
 logger = logging.getLogger(__name__)
+metrics_logger = logging.getLogger('metrics')
 logging.getLogger('urllib3').setLevel(logging.INFO)
 
 
-class RCLDAPSync:
+class WorkerLogBuffer(logging.Filter):
+    # Holds back the log records of a channel/user synced by a worker, so they can be emitted in order
+    LOGGERS = [__name__, 'rc_client', 'ldap_client', 'avatar_cache']
+
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+        for logger_name in self.LOGGERS:
+            logging.getLogger(logger_name).addFilter(self)
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    def run(self, func, *args):
+        self._local.records = records = []
+        try:
+            return func(*args), records
+        except BaseException:
+            # Nobody gets the records of a failed call, so they are emitted right away
+            self._local.records = None
+            self.emit(records)
+            raise
+        finally:
+            self._local.records = None
 
     @staticmethod
-    def from_env(sync_, loglevel=logging.INFO):
-        return RCLDAPSync(
+    def emit(records):
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+
+class RCLDAPSync:
+    ACTIONS = ['sync_users_rc_to_ldap', 'sync_channels_rc_to_ldap', 'sync_groups_ldap_to_rc']
+
+    # Watermarks of full runs start a bit before the run, so clock skew to Rocket.Chat does not lose changes
+    WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+
+    @classmethod
+    def from_env(cls, sync_, loglevel=logging.INFO, **sync_options):
+        return cls(
             RocketChatClient(
                 username=os.environ.get('RC_USERNAME'),
                 password=os.environ.get('RC_PASSWORD'),
@@ -25,6 +82,9 @@ class RCLDAPSync:
                 custom_user_field=os.environ.get('RC_CUSTOM_USER_FIELD'),
                 custom_user_field_conversions=os.environ.get('RC_CUSTOM_USER_FIELD_CONVERSIONS', {}),
                 log_level=loglevel,
+                avatar_cache_dir=os.environ.get('RC_AVATAR_CACHE_DIR'),
+                user_cache_ttl=int(os.environ['RC_USER_CACHE_TTL']) if os.environ.get('RC_USER_CACHE_TTL') else None,
+                warm_start=sync_options.get('warm_start'),
                 mongo=RocketChatMongoClient(
                     mongo_user=os.environ.get('MONGO_USERNAME'),
                     mongo_pass=os.environ.get('MONGO_PASSWORD'),
@@ -35,16 +95,19 @@ class RCLDAPSync:
                 binddn=os.environ.get('LDAP_BINDDN'),
                 password=os.environ.get('LDAP_PASSWORD'),
                 host=os.environ.get('LDAP_HOST'),
+                read_hosts=os.environ.get('LDAP_READ_HOSTS'),
                 base_dn=os.environ.get('LDAP_BASE_DN'),
                 default_users_objectclasses=os.environ.get('LDAP_USERS_OBJECTCLASSES'),
                 default_groups_objectclasses=os.environ.get('LDAP_GROUPS_OBJECTCLASSES'),
-                log_level=loglevel
+                log_level=loglevel,
+                warm_start=sync_options.get('warm_start')
             ),
-            sync=sync_ if sync_ is not None and type(sync_) is dict else {}
+            sync=sync_ if sync_ is not None and type(sync_) is dict else {},
+            **sync_options
         )
 
-    @staticmethod
-    def from_config(config_path, loglevel=logging.INFO):
+    @classmethod
+    def from_config(cls, config_path, loglevel=logging.INFO, **sync_options):
         with open(config_path, 'r') as stream:
             try:
                 config = yaml.safe_load(stream)
@@ -52,7 +115,7 @@ class RCLDAPSync:
                 logger.error(exc)
                 sys.exit(1)
 
-        return RCLDAPSync(
+        return cls(
             RocketChatClient(
                 username=config.get('RC_USERNAME'),
                 password=config.get('RC_PASSWORD'),
@@ -61,6 +124,9 @@ class RCLDAPSync:
                 custom_user_field=config.get('RC_CUSTOM_USER_FIELD'),
                 custom_user_field_conversions=config.get('RC_CUSTOM_USER_FIELD_CONVERSIONS'),
                 log_level=loglevel,
+                avatar_cache_dir=config.get('RC_AVATAR_CACHE_DIR'),
+                user_cache_ttl=config.get('RC_USER_CACHE_TTL'),
+                warm_start=sync_options.get('warm_start'),
                 mongo=RocketChatMongoClient(
                     mongo_user=config.get('MONGO_USERNAME'),
                     mongo_pass=config.get('MONGO_PASSWORD'),
@@ -71,154 +137,512 @@ class RCLDAPSync:
                 binddn=config['LDAP_BINDDN'],
                 password=config['LDAP_PASSWORD'],
                 host=config.get('LDAP_HOST'),
+                read_hosts=config.get('LDAP_READ_HOSTS'),
                 base_dn=config.get('LDAP_BASE_DN'),
                 default_users_objectclasses=config.get('LDAP_DEFAULT_USERS_OBJECTCLASSES'),
                 default_groups_objectclasses=config.get('LDAP_DEFAULT_GROUPS_OBJECTCLASSES'),
                 default_users_basedn=config.get('LDAP_DEFAULT_USERS_BASEDN'),
                 default_groups_basedn=config.get('LDAP_DEFAULT_GROUPS_BASEDN'),
-                log_level=loglevel
+                log_level=loglevel,
+                warm_start=sync_options.get('warm_start')
             ),
-            sync=config['SYNC']
+            sync=config['SYNC'],
+            **sync_options
         )
 
-    def __init__(self, rc_client, ldap_client, sync=None):
+    def __init__(self, rc_client, ldap_client, sync=None, state=None, full_sync_every_seconds=None, workers=1,
+                 pipeline_writes=False, dry_run=False, ldap_write_connections=2, metrics_textfile=None,
+                 metrics_port=None, max_deletes=None, shard_index=0, shard_count=1, process_index=0, process_count=1,
+                 lock_dir=None, warm_start=None):
         self.ldap_client = ldap_client
 
         self.rc_client = rc_client
 
         self.channels_to_sync = sync
 
+        # The channel actions only sync the SYNC groups of this shard, split further over the processes of the
+        # replica. Users are synced by the first process of shard 0.
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.process_index = process_index
+        self.process_count = process_count
+        self.syncs_users = shard_index == 0 and process_index == 0
+        self.group_locks = GroupLocks(lock_dir) if lock_dir else None
+
+        self.executor = None
+        self.new_users_lock = threading.Lock()
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            self.worker_logs = WorkerLogBuffer()
+            self.rc_client.set_pool_size(workers)
+
+        self.state = state
+        # rocketchat id -> fingerprint of what was last written to LDAP, unchanged users are skipped entirely
+        self.fingerprints = state.get('user_fingerprints', {}) if state is not None else {}
+        # While a plan is recorded: normalized dn -> (rc user, fingerprint, avatar), marked as synced once the plan
+        # applied
+        self.pending_users = {}
+        self.full_sync_every_seconds = full_sync_every_seconds
+        # Decided per action, since the scheduler may run only some of them
+        self.incremental = False
+        self.run_started_at = None
+        # action -> time it started, for the actions that ran as a full sync and are not checkpointed yet
+        self.full_syncs = {}
+
+        # Plan the LDAP writes of an action first, then print (dry run) or apply them pipelined
+        self.dry_run = dry_run
+        self.plan_executor = None
+        if pipeline_writes and not dry_run:
+            self.plan_executor = self.ldap_client.create_plan_executor(ldap_write_connections)
+
+        # Saved at every checkpoint, so a restart can revalidate the state instead of loading everything
+        self.warm_start = warm_start
+
+        # Safety net against deleting most of LDAP because of a misconfiguration or a broken RC answer
+        self.max_deletes = max_deletes
+
+        self.metrics_textfile = metrics_textfile
+        self.metrics_server = metrics.serve(metrics_port) if metrics_port else None
+
+    def run_action(self, action):
+        if action not in self.ACTIONS:
+            raise ValueError(f'Unknown action {action}')
+
+        started_at = time.time()
+        self.incremental = self._incremental_sync_due(action)
+        if self.state is not None:
+            logger.info(f'Running {action} as {"incremental" if self.incremental else "full"} sync...')
+
+        self.run_planned(action, getattr(self, action))
+
+        if not self.incremental:
+            self.full_syncs[action] = started_at
+
+    def run_planned(self, action, func, *args):
+        if self.dry_run or self.plan_executor is not None:
+            self.ldap_client.begin_plan()
+        try:
+            with metrics.timer('action_seconds', action=action):
+                func(*args)
+        finally:
+            plan = self.ldap_client.end_plan()
+
+        if plan is not None:
+            self._apply_plan(action, plan)
+
+    def _apply_plan(self, action, plan):
+        pending_users, self.pending_users = self.pending_users, {}
+        if self.dry_run:
+            print(plan.to_json())
+            logger.info(f'{action}: planned {len(plan)} LDAP operations, not applying them in a dry run')
+            return
+
+        results = self.plan_executor.apply(plan)
+        failed = 0
+        for operation, success, description in results:
+            if success:
+                logger.debug(f'  {operation.operation} {operation.dn}: {description}')
+                if normalize_dn(operation.dn) in pending_users:
+                    self._mark_user_synced(*pending_users.pop(normalize_dn(operation.dn)))
+            else:
+                failed += 1
+                logger.error(f'Could not {operation.operation} {operation.dn}: {description}')
+        logger.info(f'{action}: applied {len(results) - failed}/{len(results)} LDAP operations')
+
+    def start_run(self):
+        metrics.start_cycle()
+
+        if self.run_started_at is not None:
+            # The LDAP user snapshots are shared within a run, but LDAP may have changed since the last one
+            self.ldap_client.refresh_users_snapshots()
+            self.rc_client.expire_caches()
+
+        self.run_started_at = datetime.datetime.utcnow()
+
+    def _last_full_syncs(self):
+        # action -> timestamp of its last full sync
+        last_full_syncs = self.state.get('last_full_sync') if self.state is not None else None
+        # Used to be a single timestamp for all actions, those run a full sync again
+        return dict(last_full_syncs) if isinstance(last_full_syncs, dict) else {}
+
+    def _incremental_sync_due(self, action):
+        last_full_sync = self._last_full_syncs().get(action)
+        if last_full_sync is None:
+            return False
+        if self.full_sync_every_seconds is None:
+            return True
+        return time.time() - last_full_sync < self.full_sync_every_seconds
+
+    def _get_watermark(self, name):
+        # None means there is nothing to be incremental from, so a full sync is needed
+        if not self.incremental:
+            return None
+        return self.state.get_watermark(name)
+
+    def _set_watermark(self, name, watermark=None):
+        if self.state is None:
+            return
+        if watermark is None:
+            watermark = self.run_started_at - self.WATERMARK_OVERLAP
+        self.state.set_watermark(name, watermark)
+
+    def get_sync_groups(self):
+        # Sharded over the replicas first, so replicas with different --processes still agree
+        return {name_: channel_settings for name_, channel_settings in self.channels_to_sync.items()
+                if shard_of(name_, channel_settings, self.shard_count) == self.shard_index
+                and process_of(name_, self.process_count) == self.process_index}
+
+    def _locked_sync_groups(self):
+        # The lock of a group is held while the caller syncs it
+        for name_, channel_settings in self.get_sync_groups().items():
+            if self.group_locks is not None and not self.group_locks.acquire(name_):
+                logger.warning(f'SYNC group {name_} is synced by another worker, skipping it')
+                continue
+            try:
+                yield name_, channel_settings
+            finally:
+                if self.group_locks is not None:
+                    self.group_locks.release(name_)
+
+    def get_all_rc_channels(self, sync_groups=None):
+        if sync_groups is None:
+            sync_groups = self.channels_to_sync
+        return [rc_channel for channel_settings in sync_groups.values()
+                for rc_channel in channel_settings.get('channels')]
+
     def sync_channels_rc_to_ldap(self):
-        for name_, channel_settings in self.channels_to_sync.items():
-            logger.debug(f"Syncing channels from {name_}...")
+        self.rc_client.prefetch_rc_users()
 
-            self.ldap_client.update_settings(channel_settings)
+        since = self._get_watermark('rooms')
+        changed_channels, watermark = None, None
+        if since is not None:
+            changed_channels, watermark = self.rc_client.get_rc_channels_updated_since(
+                since, self.get_all_rc_channels(self.get_sync_groups()))
 
-            for rc_channel, ldap_group in channel_settings.get('channels').items():
-                logger.info(f'Adding RC channel "#{rc_channel}" to LDAP group "{ldap_group},{channel_settings.get("groups_basedn")}"...')
+        if not self.sync_rc_channels_to_ldap(changed_channels):
+            return
 
-                ldap_group_members = self.ldap_client.get_group_member_dns(ldap_group)
-                rc_channel_members = self.rc_client.get_rc_channel_members(rc_channel)
-                if rc_channel_members is None:
-                    logger.info(f'Channel "#{rc_channel}" in the config is not found on the Rocket.Chat instance! '
-                                f'Misconfiguration? Channel/Group renamed?')
-                    continue
+        self._set_watermark('rooms', watermark)
 
-                logger.debug(f'  RC channel members: {[i.get("username") for i in rc_channel_members]}')
-                logger.debug(f'  LDAP group members: {ldap_group_members}')
+    def sync_rc_channels_to_ldap(self, rc_channels=None):
+        # None syncs all channels
+        self.rc_client.prefetch_rc_channel_members(
+            rc_channels if rc_channels is not None else self.get_all_rc_channels(self.get_sync_groups()))
+
+        for name_, channel_settings in self._locked_sync_groups():
+            logger.debug(f"Syncing channels from {name_}...")
 
-                dn_to_have = []
+            self.ldap_client.update_settings(channel_settings)
 
-                for rc_member in rc_channel_members:
-                    rc_user = self.rc_client.get_rc_user(rc_member)
-                    if self.rc_client.should_be_skipped(rc_user):
-                        continue
+            channels = [(rc_channel, ldap_group, channel_settings)
+                        for rc_channel, ldap_group in channel_settings.get('channels').items()
+                        if rc_channels is None or rc_channel in rc_channels]
+            # Closed right away on a failure, so the other channels are stopped before returning
+            with contextlib.closing(self._map(self._sync_channel_rc_to_ldap, channels)) as results:
+                for ok in results:
+                    if not ok:
+                        return False
+        return True
+
+    def _sync_channel_rc_to_ldap(self, rc_channel, ldap_group, channel_settings):
+        with metrics.timer('channel_sync_seconds', direction='rc_to_ldap', channel=rc_channel):
+            return self._sync_channel_rc_to_ldap_timed(rc_channel, ldap_group, channel_settings)
+
+    def _sync_channel_rc_to_ldap_timed(self, rc_channel, ldap_group, channel_settings):
+        logger.info(f'Adding RC channel "#{rc_channel}" to LDAP group "{ldap_group},{channel_settings.get("groups_basedn")}"...')
+
+        # Only member is kept in sync, memberUid values are left alone
+        group_members = self.ldap_client.get_group_members(ldap_group)
+        ldap_group_members = group_members[0] if group_members is not None else None
+        rc_channel_members = self.rc_client.get_rc_channel_members(rc_channel)
+        if rc_channel_members is None:
+            logger.info(f'Channel "#{rc_channel}" in the config is not found on the Rocket.Chat instance! '
+                        f'Misconfiguration? Channel/Group renamed?')
+            return True
+
+        logger.debug(f'  RC channel members: {[i.get("username") for i in rc_channel_members]}')
+        logger.debug(f'  LDAP group members: {ldap_group_members}')
+
+        dn_to_have = []
+
+        for rc_member in rc_channel_members:
+            rc_user = self.rc_client.get_rc_user(rc_member)
+            if self.rc_client.should_be_skipped(rc_user):
+                continue
 
-                    ldap_user = self.ldap_client.get_user_by_rocketchat_id(rc_user.rocketchat_id)
-                    if ldap_user is None:
-                        dn = None
-                        if self.rc_client.custom_user_field:
+            dn = self.ldap_client.get_user_dn_by_rocketchat_id(rc_user.rocketchat_id)
+            if dn is None:
+                # Channels synced in parallel may share new users, only create them once
+                with self.new_users_lock:
+                    dn = self.ldap_client.get_user_dn_by_rocketchat_id(rc_user.rocketchat_id)
+                    if dn is None:
+                        # Entries without a rocketchatId yet are matched by their uid, and get it added
+                        dn = self.ldap_client.get_user_dn_by_uid(rc_user.username)
+                        if not dn and self.rc_client.custom_user_field:
                             dn = self.rc_client.get_dn_of_rc_user_by_custom_field(rc_user)
                         if not dn:
                             dn = f'uid={rc_user.username},{channel_settings.get("users_basedn")}'
 
-                        self.ldap_client.add_or_update_user(dn, self._get_ldap_dict(rc_user))
-                    else:
-                        dn = ldap_user.get('dn')
+                        self._add_or_update_ldap_user(dn, rc_user)
 
-                    dn_to_have.append(dn)
-
-                if dn_to_have == ldap_group_members:
-                    # In sync, everything is the way we want it
-                    continue
+            dn_to_have.append(dn)
 
-                if not self.ldap_client.set_group_members(ldap_group, dn_to_have, current_members=ldap_group_members):
-                    logger.error(f'Could not add/modify LDAP Group "{ldap_group}"!')
-                    return
+        if not self.ldap_client.set_group_members(ldap_group, dn_to_have, current_members=ldap_group_members):
+            logger.error(f'Could not add/modify LDAP Group "{ldap_group}"!')
+            return False
+        return True
 
     def sync_groups_ldap_to_rc(self):
-        for base_dn, channel_settings in self.channels_to_sync.items():
+        self.rc_client.prefetch_rc_users()
+        self.rc_client.prefetch_rc_channel_members(self.get_all_rc_channels(self.get_sync_groups()))
+
+        for base_dn, channel_settings in self._locked_sync_groups():
             self.ldap_client.update_settings(channel_settings)
-            for rc_channel, ldap_group in channel_settings.get('channels').items():
-                logger.info(f'Adding LDAP-Group "{ldap_group},{channel_settings.get("groups_basedn")}" to RC channel "{rc_channel}"...')
 
-                rc_channel_members = self.rc_client.get_rc_channel_members(rc_channel)
-                if rc_channel_members is None:
-                    logger.debug(f'Adding RC group {rc_channel}...')
-                    if not self.rc_client.add_group(rc_channel):
-                        logger.error(f'Could not add RC group {rc_channel}!')
+            channels = [(rc_channel, ldap_group, channel_settings)
+                        for rc_channel, ldap_group in channel_settings.get('channels').items()]
+            with contextlib.closing(self._map(self._sync_group_ldap_to_rc, channels)) as results:
+                for ok in results:
+                    if not ok:
                         return
-                    rc_channel_members = []
 
-                ldap_group_members = self.ldap_client.get_group_member_dns(ldap_group)
-                if ldap_group_members is None:
-                    logger.debug(f'LDAP Group "{ldap_group}" is missing, skipping...')
+    def _sync_group_ldap_to_rc(self, rc_channel, ldap_group, channel_settings):
+        with metrics.timer('channel_sync_seconds', direction='ldap_to_rc', channel=rc_channel):
+            return self._sync_group_ldap_to_rc_timed(rc_channel, ldap_group, channel_settings)
+
+    def _sync_group_ldap_to_rc_timed(self, rc_channel, ldap_group, channel_settings):
+        logger.info(f'Adding LDAP-Group "{ldap_group},{channel_settings.get("groups_basedn")}" to RC channel "{rc_channel}"...')
+
+        rc_channel_members = self.rc_client.get_rc_channel_members(rc_channel)
+        if rc_channel_members is None:
+            logger.debug(f'Adding RC group {rc_channel}...')
+            if self.dry_run:
+                logger.info(f'    Would add RC group "#{rc_channel}" (dry run)')
+                return True
+            if not self.rc_client.add_group(rc_channel):
+                logger.error(f'Could not add RC group {rc_channel}!')
+                return False
+            rc_channel_members = []
+
+        ldap_group_members = self.ldap_client.get_group_member_dns(ldap_group)
+        if ldap_group_members is None:
+            logger.debug(f'LDAP Group "{ldap_group}" is missing, skipping...')
+            return True
+
+        logger.debug(f'  LDAP group members: {ldap_group_members}')
+        logger.debug(f'  RC channel members: {[i["username"] for i in rc_channel_members]}')
+
+        rc_channel_member_uids = {i.get('username') for i in rc_channel_members}
+        missing_uids = {i.split('=', 1)[1].split(',')[0] for i in ldap_group_members} - rc_channel_member_uids
+        if not missing_uids:
+            return True
+
+        self.rc_client.prefetch_rc_users(missing_uids)
+        uids_to_add = {}
+        for member_uid in sorted(missing_uids):
+            rc_user = self.rc_client.get_rc_user(member_uid)
+            if self.rc_client.should_be_skipped(rc_user):
+                continue
+            uids_to_add[rc_user.rocketchat_id] = member_uid
+
+        if self.dry_run:
+            logger.info(f'    Would add LDAP users {sorted(uids_to_add.values())} to RC channel "#{rc_channel}" (dry run)')
+            return True
+
+        failed_ids = set(self.rc_client.add_userids_to_channel(uids_to_add.keys(), rc_channel))
+        for rocketchat_id, member_uid in uids_to_add.items():
+            if rocketchat_id not in failed_ids:
+                logger.info(f'    Added LDAP user "{member_uid}" to RC channel "#{rc_channel}"')
+            else:
+                logger.info(f'    ! LDAP user "{member_uid}" could not be added, has no RC-account yet')
+        return True
+
+    def _map(self, func, args_list):
+        # Yields the results in the order of args_list, also with workers
+        if self.executor is None:
+            for args in args_list:
+                yield func(*args)
+            return
+
+        futures = collections.deque(self.executor.submit(self.worker_logs.run, func, *args) for args in args_list)
+        try:
+            while futures:
+                result, records = futures.popleft().result()
+                self.worker_logs.emit(records)
+                yield result
+        finally:
+            # The caller may stop at the first failure. Then nothing of this call may keep writing once it returned,
+            # so the calls not started yet are cancelled and the running ones waited for, with their logs.
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if future.cancelled():
                     continue
-
-                logger.debug(f'  LDAP group members: {ldap_group_members}')
-                logger.debug(f'  RC channel members: {[i["username"] for i in rc_channel_members]}')
-
-                rc_channel_member_uids = [i.get('uid') for i in rc_channel_members]
-                for member_uid in [i.split('=', 1)[1].split(',')[0] for i in ldap_group_members]:
-                    if member_uid not in rc_channel_member_uids:
-                        rc_user = self.rc_client.get_rc_user(member_uid)
-                        if self.rc_client.should_be_skipped(rc_user):
-                            continue
-
-                        if self.rc_client.add_userid_to_channel(rc_user.rocketchat_id, rc_channel):
-                            logger.info(f'    Added LDAP user "{member_uid}" to RC channel "#{rc_channel}"')
-                        else:
-                            logger.info(f'    ! LDAP user "{member_uid}" could not be added, has no RC-account yet')
+                try:
+                    _, records = future.result()
+                except Exception:
+                    logger.exception('Worker failed after the sync stopped')
+                else:
+                    self.worker_logs.emit(records)
 
     def sync_users_rc_to_ldap(self):
+        if not self.syncs_users:
+            logger.debug('Users are synced by the first process of shard 0')
+            return
+
+        since = self._get_watermark('users')
+        if since is not None:
+            # Deletions are only detected by the full sync
+            self._sync_changed_users_rc_to_ldap(since)
+            return
+
+        # Users cached by earlier runs may predate their latest changes
+        self.rc_client.forget_rc_users()
         if self.rc_client.custom_user_field:
             # Since the custom user field sets the user_dn, generate all users up front
-            self._add_users_rc_to_ldap_with_custom_field()
+            results = self._add_users_rc_to_ldap_with_custom_field()
         else:
             # Iterate through all sync-groups and get user_dn from channels
-            self._add_users_rc_to_ldap_with_channels()
+            results = self._add_users_rc_to_ldap_with_channels()
 
-        all_ldap_users = self.ldap_client.get_all_users(self.ldap_client.ldap_base_dn)
-        for ldap_dn, ldap_user in all_ldap_users.items():
-            ldap_uid = ldap_user.get('attributes', {}).get("uid")
-            if type(ldap_uid) is list:
-                ldap_uid = ldap_uid[0]
-            if ldap_uid not in self.rc_client.known_rc_users:
-                self.ldap_client.delete_dn(ldap_dn)
+        # Compared against all RC users, so users merely not touched in this run are kept
+        rc_usernames = self.rc_client.get_all_rc_usernames()
+        if rc_usernames is None:
+            logger.error('Could not get all Rocket.Chat users, not deleting any LDAP users!')
+        else:
+            all_ldap_users = self.ldap_client.get_users_snapshot(self.ldap_client.ldap_base_dn)
+            results['deleted'], results['refused'] = self.ldap_client.delete_users_not_in_rc(
+                all_ldap_users, rc_usernames, max_deletes=self.max_deletes)
 
-    def _add_users_rc_to_ldap_with_custom_field(self):
-        all_rc_users = self.rc_client.get_all_users()
-        for rc_user_info in all_rc_users:
-            rc_user = self.rc_client.get_rc_user(rc_user_info)
-            if rc_user is None:
-                logger.warning(f"Skipping user {rc_user_info.get('username')}")
+        self._log_user_results(results)
+        self._set_watermark('users')
+
+    def _sync_changed_users_rc_to_ldap(self, since):
+        rc_users = self.rc_client.get_rc_users_updated_since(since)
+        watermark = max([since] + [rc_user.updated_at for rc_user in rc_users if rc_user.updated_at is not None])
+
+        self._log_user_results(self.update_ldap_users(rc_users))
+
+        self._set_watermark('users', watermark)
+
+    @staticmethod
+    def _log_user_results(results):
+        for result, count in results.items():
+            metrics.inc('ldap_users_total', count, result=result)
+        logger.info(f'Users: {results["created"]} created, {results["updated"]} updated, '
+                    f'{results["unchanged"]} unchanged, {results["deleted"]} deleted, {results["failed"]} failed')
+        if results['refused']:
+            logger.error(f'Users: {results["refused"]} not deleted, more than --max_deletes')
+
+    def update_ldap_users(self, rc_users):
+        users_to_update = []
+        for rc_user in rc_users:
+            if self.rc_client.should_be_skipped(rc_user):
                 continue
 
-            dn = self.rc_client.get_dn_of_rc_user_by_custom_field(rc_user)
+            if self.rc_client.custom_user_field:
+                dn = self.rc_client.get_dn_of_rc_user_by_custom_field(rc_user)
+            else:
+                # New users are created by the channel sync or the next full sync
+                dn = self.ldap_client.get_user_dn_by_rocketchat_id(rc_user.rocketchat_id)
+
             if dn:
-                try:
-                    self.ldap_client.add_or_update_user(dn, self._get_ldap_dict(rc_user))
-                except TypeError:
-                    print(rc_user_info)
-                    print(rc_user)
+                users_to_update.append((dn, rc_user))
+
+        return collections.Counter(self._add_or_update_ldap_user(dn, rc_user) for dn, rc_user in users_to_update)
+
+    def _add_users_rc_to_ldap_with_custom_field(self):
+        all_rc_users = self.rc_client.get_all_users()
+        self.rc_client.prefetch_rc_users(rc_user_info.get('username') for rc_user_info in all_rc_users)
+        results = collections.Counter(self._add_user_rc_to_ldap_with_custom_field(rc_user_info)
+                                      for rc_user_info in all_rc_users)
+        results.pop(None, None)
+        return results
+
+    def _add_user_rc_to_ldap_with_custom_field(self, rc_user_info):
+        rc_user = self.rc_client.get_rc_user(rc_user_info)
+        if rc_user is None:
+            logger.warning(f"Skipping user {rc_user_info.get('username')}")
+            return
+
+        dn = self.rc_client.get_dn_of_rc_user_by_custom_field(rc_user)
+        if dn:
+            try:
+                return self._add_or_update_ldap_user(dn, rc_user)
+            except TypeError:
+                print(rc_user_info)
+                print(rc_user)
 
     def _add_users_rc_to_ldap_with_channels(self):
-        users_added_cache = []
+        self.rc_client.prefetch_rc_channel_members(self.get_all_rc_channels())
+        # The users were forgotten, so get them with the members instead of one query each
+        self.rc_client.prefetch_rc_users(member.get('username') for members in self.rc_client.rc_channel_members.values()
+                                         for member in members or [])
+
+        results = collections.Counter()
+        users_added_cache = set()
         for name_, channel_settings in self.channels_to_sync.items():
             logger.debug(f"Adding users from {name_}...")
             self.ldap_client.update_settings(channel_settings)
+
+            users_to_add = []
             for rc_channel, ldap_group in channel_settings.get('channels').items():
-                rc_channel_members = self.rc_client.get_rc_channel_members(rc_channel)
+                rc_channel_members = self.rc_client.get_rc_channel_members(rc_channel) or []
 
                 for user_simple in rc_channel_members:
                     rc_user = self.rc_client.get_rc_user(user_simple)
                     if not self.rc_client.should_be_skipped(rc_user) and rc_user.username not in users_added_cache:
-                        self.ldap_client.add_or_update_user(f'uid={rc_user.username}', self._get_ldap_dict(rc_user))
-                        users_added_cache.append(rc_user.username)
-
-    def _get_ldap_dict(self, user):
-        avatar = self.rc_client.get_user_avatar(user.raw)
-
+                        users_to_add.append((f'uid={rc_user.username}', rc_user))
+                        users_added_cache.add(rc_user.username)
+
+            results.update(self._add_or_update_ldap_user(dn, rc_user) for dn, rc_user in users_to_add)
+        return results
+
+    def _add_or_update_ldap_user(self, dn, rc_user):
+        dn = self.ldap_client.complete_user_dn(dn)
+
+        # Known without a download if the avatar cache holds the current version. Without a cache, the version stands
+        # for the avatar. Otherwise, e.g. for the default avatar, which has no version, it is downloaded for its digest.
+        avatar = None
+        avatar_digest = self.rc_client.get_cached_avatar_digest(rc_user)
+        if avatar_digest is None and self.rc_client.avatar_cache is None:
+            avatar_digest = rc_user.avatar_version
+        if avatar_digest is None:
+            avatar, avatar_changed = self.rc_client.get_user_avatar(rc_user)
+            avatar_digest = AvatarCache.digest(avatar)
+
+        fingerprint = self._get_fingerprint(dn, rc_user, avatar_digest)
+        if self.fingerprints.get(rc_user.rocketchat_id) == fingerprint and self.ldap_client.has_user(dn):
+            metrics.inc('user_fingerprint_total', result='hit')
+            return 'unchanged'
+        metrics.inc('user_fingerprint_total', result='miss')
+
+        if avatar is None:
+            avatar, avatar_changed = self.rc_client.get_user_avatar(rc_user)
+        unchanged_attributes = () if avatar_changed else ('thumbnailPhoto', 'jpegPhoto')
+
+        result = self.ldap_client.add_or_update_user(dn, self._get_ldap_dict(rc_user, avatar),
+                                                     unchanged_attributes=unchanged_attributes)
+        if result in ('created', 'updated', 'unchanged'):
+            if result == 'unchanged' or self.ldap_client.plan is None:
+                self._mark_user_synced(rc_user, fingerprint, avatar)
+            else:
+                self.pending_users[normalize_dn(dn)] = (rc_user, fingerprint, avatar)
+        return result
+
+    def _mark_user_synced(self, rc_user, fingerprint, avatar):
+        # Only after the LDAP entry was written, so failed writes are retried
+        self.fingerprints[rc_user.rocketchat_id] = fingerprint
+        self.rc_client.mark_avatar_synced(rc_user, avatar)
+
+    def _get_fingerprint(self, dn, rc_user, avatar_digest):
+        # Covers everything written to the LDAP entry
+        content = json.dumps([normalize_dn(dn), rc_user.username, rc_user.name, rc_user.mail, rc_user.password_hash,
+                              sorted(rc_user.roles), avatar_digest,
+                              sorted(objectclass.lower() for objectclass in self.ldap_client.ldap_users_objectclasses)])
+        return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+    def _get_ldap_dict(self, user, avatar):
         logger.debug(f'uid:{user.username} - cn:{user.name}')
         return {'cn': user.name, 'mail': user.mail, 'uid': user.username,
                 'userPassword': "{SHA256-BCRYPT}" + user.password_hash,
@@ -226,9 +650,40 @@ class RCLDAPSync:
                 'jpegPhoto': avatar,
                 'rocketchatId': user.rocketchat_id}
 
+    def checkpoint(self):
+        if self.dry_run:
+            # Nothing was written, so neither avatars nor watermarks are synced
+            return
+
+        self.rc_client.save_caches()
+        if self.warm_start is not None:
+            self.warm_start.save(self.ldap_client, self.rc_client)
+
+        if self.state is not None:
+            self.state.set('user_fingerprints', self.fingerprints)
+            last_full_syncs = self._last_full_syncs()
+            last_full_syncs.update(self.full_syncs)
+            self.full_syncs = {}
+            self.state.set('last_full_sync', last_full_syncs)
+            self.state.save()
+
+    def finish_run(self):
+        summary = metrics.end_cycle()
+        metrics_logger.info(json.dumps(summary))
+        if self.metrics_textfile:
+            metrics.write_textfile(self.metrics_textfile)
+        return summary
+
     def close(self):
+        self.checkpoint()
         self.rc_client.session.close()
-        self.ldap_client.ldap_connection.unbind()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.plan_executor is not None:
+            self.plan_executor.close()
+        self.ldap_client.unbind()
 
 
 def parse_args():
@@ -236,25 +691,109 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-q', '--quiet', action="store_true")
-    parser.add_argument('--repeat_every_seconds', type=int)
+    parser.add_argument('--repeat_every_seconds', type=int, help='Run the actions periodically')
+    parser.add_argument('--every', action='append', default=[], metavar='ACTION=SECONDS',
+                        help='Run ACTION periodically with its own interval, overriding --repeat_every_seconds')
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help='Delay periodic runs randomly by up to this fraction of their interval')
+    parser.add_argument('--watch', action="store_true",
+                        help='Run the actions once, then apply membership and user changes as they happen. '
+                             'Needs MongoDB as a replica set')
+    parser.add_argument('--watch_debounce_seconds', type=float, default=0.5,
+                        help='Wait until there were no changes for this long before applying them')
     parser.add_argument('--config', type=str)
     parser.add_argument('--channel', nargs='*')
-    parser.add_argument('actions', nargs='+', choices=['sync_users_rc_to_ldap', 'sync_channels_rc_to_ldap',
-                                                       'sync_groups_ldap_to_rc'])
+    parser.add_argument('--workers', type=int, default=1, help='Sync this many channels in parallel')
+    parser.add_argument('--state_file', type=str, help='Where to keep the watermarks for incremental syncs')
+    parser.add_argument('--incremental', action="store_true",
+                        help='Only sync users/channels changed since the last run. Needs --state_file')
+    parser.add_argument('--full_sync_every_seconds', type=int, default=86400,
+                        help='Run a full sync at least this often in incremental mode')
+    parser.add_argument('--pipeline_writes', action="store_true",
+                        help='Plan all LDAP changes of an action, then send them pipelined')
+    parser.add_argument('--ldap_write_connections', type=int, default=2,
+                        help='Connections to send the planned LDAP changes over')
+    parser.add_argument('--dry_run', action="store_true", help='Print the planned LDAP changes as JSON, change nothing')
+    parser.add_argument('--max_deletes', type=int, default=100,
+                        help='Do not delete any LDAP users if more than this many are missing in Rocket.Chat')
+    parser.add_argument('--warm_start_file', type=str,
+                        help='Keep the LDAP users and rooms in this file, so a restart only revalidates them')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help='Only sync the SYNC groups of this shard, for several replicas of the sync')
+    parser.add_argument('--shard_count', type=int, default=1, help='Number of replicas the SYNC groups are split over')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Split the SYNC groups of this replica further over this many processes')
+    parser.add_argument('--lock_dir', type=str,
+                        help='Lock every SYNC group in a lock file here while syncing it, so workers never overlap')
+    parser.add_argument('--metrics_textfile', type=str,
+                        help='Write Prometheus metrics to this file after every run (node_exporter textfile collector)')
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on this port')
+    parser.add_argument('actions', nargs='+', choices=RCLDAPSync.ACTIONS)
 
     _args = parser.parse_args()
     return _args
 
 
 def run_actions(sync_, actions):
+    sync_.start_run()
+
     # preserve the order
     for action in actions:
-        if 'sync_users_rc_to_ldap' == action:
-            sync_.sync_users_rc_to_ldap()
-        if 'sync_channels_rc_to_ldap' == action:
-            sync_.sync_channels_rc_to_ldap()
-        if 'sync_groups_ldap_to_rc' == action:
-            sync_.sync_groups_ldap_to_rc()
+        sync_.run_action(action)
+
+    sync_.checkpoint()
+    return sync_.finish_run()
+
+
+def run(args, log_level, intervals, shard_index=0, shard_count=1, process_index=0, process_count=1):
+    # Returns the summary of a single run, None in watch and daemon mode
+    shard_suffix = f'.shard{shard_index}' if shard_count > 1 else ''
+    if process_count > 1:
+        shard_suffix += f'.process{process_index}'
+    sync_options = {'workers': args.workers, 'pipeline_writes': args.pipeline_writes, 'dry_run': args.dry_run,
+                    'ldap_write_connections': args.ldap_write_connections,
+                    'metrics_textfile': args.metrics_textfile + shard_suffix if args.metrics_textfile else None,
+                    'metrics_port': args.metrics_port + process_index if args.metrics_port else None,
+                    'max_deletes': args.max_deletes, 'shard_index': shard_index, 'shard_count': shard_count,
+                    'process_index': process_index, 'process_count': process_count,
+                    'lock_dir': args.lock_dir}
+    if args.warm_start_file:
+        sync_options['warm_start'] = WarmStart(args.warm_start_file + shard_suffix)
+    if args.state_file:
+        sync_options['state'] = SyncState(args.state_file + shard_suffix)
+        if args.incremental:
+            sync_options['full_sync_every_seconds'] = args.full_sync_every_seconds
+        else:
+            # Still record the watermarks, but never skip anything
+            sync_options['full_sync_every_seconds'] = 0
+
+    if args.config:
+        rcldap_sync = RCLDAPSync.from_config(args.config, loglevel=log_level, **sync_options)
+    else:
+        rcldap_sync = RCLDAPSync.from_env(args.channel, loglevel=log_level, **sync_options)
+
+    summary = None
+    if args.watch:
+        watcher = RCLDAPWatcher(rcldap_sync, debounce_seconds=args.watch_debounce_seconds)
+        signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+        try:
+            watcher.run(catch_up=lambda: run_actions(rcldap_sync, args.actions))
+        except KeyboardInterrupt:
+            pass
+    elif args.repeat_every_seconds or args.every:
+        scheduler = Scheduler(jitter=args.jitter)
+        for action in args.actions:
+            scheduler.add(action, intervals.get(action, args.repeat_every_seconds))
+        signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+        try:
+            scheduler.run(lambda actions: run_actions(rcldap_sync, actions))
+        except KeyboardInterrupt:
+            pass
+    else:
+        summary = run_actions(rcldap_sync, args.actions)
+
+    rcldap_sync.close()
+    return summary
 
 
 if __name__ == '__main__':
@@ -268,15 +807,35 @@ if __name__ == '__main__':
         log_level = logging.INFO
     logging.basicConfig(level=log_level)
 
-    if args.config:
-        rcldap_sync = RCLDAPSync.from_config(args.config, loglevel=log_level)
+    intervals = {}
+    for every in args.every:
+        action, _, seconds = every.partition('=')
+        if action not in args.actions or not seconds.isdigit() or int(seconds) <= 0:
+            logger.error(f'--every needs ACTION=SECONDS with one of the given actions, not "{every}"')
+            sys.exit(1)
+        intervals[action] = int(seconds)
+    if args.every and not args.repeat_every_seconds and set(intervals) != set(args.actions):
+        logger.error('Without --repeat_every_seconds, every action needs an interval with --every')
+        sys.exit(1)
+    if args.watch and (args.repeat_every_seconds or args.every):
+        logger.error('--watch cannot be combined with periodic runs')
+        sys.exit(1)
+
+    if args.incremental and not args.state_file:
+        logger.error('--incremental needs a --state_file to keep the watermarks in!')
+        sys.exit(1)
+    if not 0 <= args.shard_index < args.shard_count or args.processes < 1:
+        logger.error('--shard_index has to be below --shard_count and --processes at least 1')
+        sys.exit(1)
+
+    if args.processes == 1:
+        run(args, log_level, intervals, args.shard_index, args.shard_count)
     else:
-        rcldap_sync = RCLDAPSync.from_env(args.channel, loglevel=log_level)
-
-    run_actions(rcldap_sync, args.actions)
-    if args.repeat_every_seconds:
-        import time
-        while not time.sleep(args.repeat_every_seconds):
-            run_actions(rcldap_sync, args.actions)
-
-    rcldap_sync.close()
+        # Every process syncs a part of the groups of this replica's shard
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        shards = [(args, log_level, intervals, args.shard_index, args.shard_count, process_index, args.processes)
+                  for process_index in range(args.processes)]
+        with multiprocessing.get_context('fork').Pool(args.processes) as pool:
+            summaries = pool.starmap(run, shards)
+        if all(summaries):
+            metrics_logger.info(json.dumps(merge_summaries(summaries)))
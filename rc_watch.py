@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RCLDAPWatcher:
+    # Applies membership and user changes from MongoDB change streams, instead of re-scanning everything
+    RESUME_TOKEN_KEY = 'change_stream_resume_token'
+    # Save the resume token at least this often while no relevant changes come in
+    RESUME_TOKEN_SAVE_SECONDS = 60
+    CHANGE_STREAM_HISTORY_LOST = 286
+
+    def __init__(self, sync_, debounce_seconds=0.5, max_delay_seconds=5.0):
+        self.sync = sync_
+        self.rc_client = sync_.rc_client
+        self.ldap_client = sync_.ldap_client
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.stopped = threading.Event()
+
+        self.channels = set()
+        self.channel_names = {}
+
+        # Changes are coalesced per room and user until the stream is quiet for debounce_seconds
+        self.changed_channels = set()
+        self.changed_user_ids = set()
+        self.deleted_user_ids = set()
+        self.first_change_at = None
+        self.last_change_at = None
+        self.token_saved_at = time.monotonic()
+
+    def _load_channels(self):
+        # room id -> rc_channel, as changes of rooms only carry the id
+        for rc_channel in self.sync.get_all_rc_channels(self.sync.get_sync_groups()):
+            self.channels.add(rc_channel)
+            room = self.rc_client.get_room(rc_channel)
+            if room is not None:
+                self.channel_names[room[0]] = rc_channel
+
+    def _open_stream(self):
+        resume_token = self.sync.state.get(self.RESUME_TOKEN_KEY) if self.sync.state is not None else None
+        max_await_time_ms = int(min(self.debounce_seconds, 1) * 1000)
+        try:
+            return self.rc_client.mongo.watch(resume_token, max_await_time_ms=max_await_time_ms)
+        except OperationFailure as exc:
+            if resume_token is None or exc.code != self.CHANGE_STREAM_HISTORY_LOST:
+                raise
+            logger.warning('The saved resume token is too old for the oplog, changes since then are only '
+                           'picked up by the next full sync')
+            return self.rc_client.mongo.watch(None, max_await_time_ms=max_await_time_ms)
+
+    def run(self, catch_up=None):
+        # catch_up runs after the stream is opened, so changes during it are not lost
+        if not self.rc_client.USE_MONGODB or self.rc_client.mongo is None:
+            logger.error('Watching for changes needs MongoDB access!')
+            return
+
+        self._load_channels()
+        with self._open_stream() as stream:
+            if catch_up is not None:
+                catch_up()
+
+            logger.info(f'Watching {len(self.channels)} channels and all users for changes...')
+            while not self.stopped.is_set() and stream.alive:
+                try:
+                    change = stream.try_next()
+                except PyMongoError as exc:
+                    logger.error(f'Change stream failed: {exc}')
+                    break
+
+                now = time.monotonic()
+                if change is not None and self._collect(change):
+                    self.first_change_at = self.first_change_at or now
+                    self.last_change_at = now
+
+                if self.first_change_at is None:
+                    if now - self.token_saved_at > self.RESUME_TOKEN_SAVE_SECONDS:
+                        self._save_resume_token(stream.resume_token)
+                elif now - self.first_change_at >= self.max_delay_seconds or \
+                        (change is None and now - self.last_change_at >= self.debounce_seconds):
+                    self._flush(stream.resume_token)
+
+    def _collect(self, change):
+        parsed = self.rc_client.mongo.parse_change(change)
+        if parsed is None:
+            return False
+
+        kind, document_id, name = parsed
+        metrics.inc('watch_changes_total', kind=kind)
+        if kind == 'room':
+            if name in self.channels:
+                # New rooms and subscriptions carry the name, so rooms created later are picked up too
+                self.channel_names[document_id] = name
+            rc_channel = self.channel_names.get(document_id)
+            if rc_channel is None:
+                return False
+            self.changed_channels.add(rc_channel)
+        elif not self.sync.syncs_users:
+            # Users are synced by the first process of shard 0
+            return False
+        elif kind == 'user':
+            self.changed_user_ids.add(document_id)
+            self.deleted_user_ids.discard(document_id)
+        else:
+            self.deleted_user_ids.add(document_id)
+            self.changed_user_ids.discard(document_id)
+        return True
+
+    def _flush(self, resume_token):
+        changed_channels, self.changed_channels = self.changed_channels, set()
+        changed_user_ids, self.changed_user_ids = self.changed_user_ids, set()
+        deleted_user_ids, self.deleted_user_ids = self.deleted_user_ids, set()
+        self.first_change_at = self.last_change_at = None
+
+        metrics.start_cycle()
+        logger.info(f'Applying changes of {len(changed_channels)} channels, {len(changed_user_ids)} changed and '
+                    f'{len(deleted_user_ids)} deleted users...')
+        self.sync.run_planned('watch', self._apply, changed_channels, changed_user_ids, deleted_user_ids)
+        self.rc_client.save_caches()
+        # Only saved once the changes are applied, so a restart picks up from the first unapplied change
+        self._save_resume_token(resume_token)
+        self.sync.finish_run()
+
+    def _apply(self, changed_channels, changed_user_ids, deleted_user_ids):
+        for rocketchat_id in deleted_user_ids:
+            dn = self.ldap_client.get_user_dn_by_rocketchat_id(rocketchat_id)
+            if dn is not None:
+                self.ldap_client.delete_dn(dn)
+
+        if changed_user_ids:
+            self.sync.update_ldap_users(self.rc_client.get_rc_users_by_ids(changed_user_ids))
+
+        if changed_channels:
+            self.sync.sync_rc_channels_to_ldap(changed_channels)
+
+    def _save_resume_token(self, resume_token):
+        self.token_saved_at = time.monotonic()
+        if self.sync.state is None or resume_token is None or self.sync.dry_run:
+            return
+        self.sync.state.set(self.RESUME_TOKEN_KEY, resume_token)
+        self.sync.state.save()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,70 @@
+import logging
+import random
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, name, interval, jitter=0.0, start=0.0):
+        self.name = name
+        self.interval = interval
+        self.jitter = jitter
+        self.start = start
+        self.tick = 0
+        self.next_run = start
+
+    def advance(self, now):
+        # Ticks stay on the grid start + n * interval, so a slow run does not shift every later run. Ticks which
+        # already passed are skipped instead of being run back to back.
+        self.tick += 1
+        skipped = 0
+        while self.start + self.tick * self.interval <= now:
+            self.tick += 1
+            skipped += 1
+
+        offset = random.uniform(0, self.jitter * self.interval) if self.jitter else 0.0
+        self.next_run = self.start + self.tick * self.interval + offset
+        return skipped
+
+
+class Scheduler:
+    # Runs jobs with their own interval on a single thread, so runs never overlap
+    def __init__(self, jitter=0.1, clock=time.monotonic):
+        self.jitter = jitter
+        self.clock = clock
+        self.jobs = []
+        self.stopped = threading.Event()
+
+    def add(self, name, interval):
+        self.jobs.append(Job(name, interval, jitter=self.jitter, start=self.clock()))
+
+    def due(self):
+        now = self.clock()
+        return [job for job in self.jobs if job.next_run <= now]
+
+    def run(self, callback):
+        # callback gets the names of all due jobs, in the order they were added
+        while not self.stopped.is_set():
+            jobs = self.due()
+            if jobs:
+                try:
+                    callback([job.name for job in jobs])
+                except Exception:
+                    logger.exception(f'Run of {", ".join(job.name for job in jobs)} failed')
+
+                now = self.clock()
+                for job in jobs:
+                    skipped = job.advance(now)
+                    if skipped:
+                        metrics.inc('scheduler_skipped_total', skipped, job=job.name)
+                        logger.warning(f'{job.name} overran its interval of {job.interval}s, '
+                                       f'skipped {skipped} run(s)')
+
+            self.stopped.wait(max(min(job.next_run for job in self.jobs) - self.clock(), 0))
+
+    def stop(self):
+        self.stopped.set()
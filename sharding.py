@@ -0,0 +1,53 @@
+import fcntl
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _score(shard, name):
+    return hashlib.sha1(f'{shard}:{name}'.encode()).digest()
+
+
+def shard_of(name, settings, shard_count):
+    # An explicit "shard" of the SYNC group wins. Otherwise rendezvous hashing, so changing the number of shards
+    # only moves the groups of the added/removed shards.
+    if settings.get('shard') is not None:
+        return int(settings.get('shard')) % shard_count
+    return max(range(shard_count), key=lambda shard: _score(shard, name))
+
+
+def process_of(name, process_count):
+    # Splits the groups of one shard over its local processes. Hashed apart from the shards, since the groups of
+    # a shard all scored highest for that shard.
+    return max(range(process_count), key=lambda process: _score(f'process{process}', name))
+
+
+class GroupLocks:
+    # Lock files, so two workers never sync the same SYNC group at the same time. Across hosts, lock_dir has to
+    # be on a filesystem with working flock().
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        os.makedirs(lock_dir, exist_ok=True)
+        self._lock_files = {}
+
+    def _lock_path(self, name):
+        return os.path.join(self.lock_dir, hashlib.sha1(name.encode()).hexdigest()[:16] + '.lock')
+
+    def acquire(self, name):
+        lock_file = open(self._lock_path(name), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self._lock_files[name] = lock_file
+        return True
+
+    def release(self, name):
+        lock_file = self._lock_files.pop(name, None)
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
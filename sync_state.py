@@ -0,0 +1,54 @@
+import datetime
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def parse_timestamp(value):
+    # Mongo returns naive UTC datetimes, the REST API ISO strings like 2020-01-01T12:00:00.000Z
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, dict):
+        value = value.get('$date')
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except (AttributeError, ValueError):
+        logger.debug(f'Could not parse timestamp {value}')
+        return None
+
+
+class SyncState:
+    def __init__(self, path):
+        self.path = path
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            logger.warning(f'Could not read sync state from {self.path}, starting from scratch: {exc}')
+            return {}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value):
+        self.state[key] = value
+
+    def get_watermark(self, name):
+        return parse_timestamp(self.state.get('watermarks', {}).get(name))
+
+    def set_watermark(self, name, timestamp):
+        if timestamp is None:
+            return
+        self.state.setdefault('watermarks', {})[name] = timestamp.isoformat()
@@ -0,0 +1,184 @@
+import json
+
+import ldap3
+import pytest
+from ldap3.core.exceptions import LDAPBindError, LDAPResponseTimeoutError
+
+from ldap_plan import ChangePlan, LDAPOperation, PlanExecutor
+
+BASE_DN = 'dc=example,dc=org'
+BINDDN = f'cn=admin,{BASE_DN}'
+PASSWORD = 'secret'
+
+
+def _operations(plan):
+    return [(operation.operation, operation.dn) for operation in plan.operations]
+
+
+def _member_changes(*dns, operation=ldap3.MODIFY_ADD):
+    return {'member': [(operation, list(dns))]}
+
+
+def test_modifies_of_one_entry_are_merged():
+    plan = ChangePlan()
+    plan.modify('cn=a,ou=groups', _member_changes('uid=1'))
+    plan.modify('CN=A,ou=groups', _member_changes('uid=2'))
+    plan.modify('cn=a,ou=groups', {'description': [(ldap3.MODIFY_REPLACE, ['x'])]})
+
+    assert len(plan) == 1
+    assert plan.operations[0].changes == {'member': [(ldap3.MODIFY_ADD, ['uid=1']), (ldap3.MODIFY_ADD, ['uid=2'])],
+                                          'description': [(ldap3.MODIFY_REPLACE, ['x'])]}
+
+
+def test_replace_drops_earlier_changes_of_the_attribute():
+    plan = ChangePlan()
+    plan.modify('cn=a', _member_changes('uid=1'))
+    plan.modify('cn=a', _member_changes('uid=2', operation=ldap3.MODIFY_REPLACE))
+
+    assert plan.operations[0].changes == {'member': [(ldap3.MODIFY_REPLACE, ['uid=2'])]}
+
+
+def test_modifies_are_chunked_by_max_values():
+    plan = ChangePlan(max_values=2)
+    for i in range(5):
+        plan.modify('cn=a', _member_changes(f'uid={i}'))
+
+    assert [operation.changes['member'] for operation in plan.operations] == [
+        [(ldap3.MODIFY_ADD, ['uid=0']), (ldap3.MODIFY_ADD, ['uid=1'])],
+        [(ldap3.MODIFY_ADD, ['uid=2']), (ldap3.MODIFY_ADD, ['uid=3'])],
+        [(ldap3.MODIFY_ADD, ['uid=4'])]]
+
+    # Chunks of one entry are sent one after another, a phase each
+    modify_phases = list(plan.phases())[2:]
+    assert [len(phase) for phase in modify_phases] == [1, 1, 1]
+
+
+def test_delete_drops_earlier_changes_of_the_entry():
+    plan = ChangePlan()
+    plan.modify('cn=a', _member_changes('uid=1'))
+    plan.delete('cn=a')
+
+    assert _operations(plan) == [(LDAPOperation.DELETE, 'cn=a')]
+
+
+def test_delete_of_an_entry_added_by_the_plan_sends_nothing():
+    plan = ChangePlan()
+    plan.add('cn=a', ['groupOfNames'], {'cn': 'a'})
+    plan.modify('cn=a', _member_changes('uid=1'))
+    plan.delete('cn=a')
+
+    assert len(plan) == 0
+
+
+def test_delete_then_add_keeps_both():
+    plan = ChangePlan()
+    plan.delete('cn=a')
+    plan.add('cn=a', ['groupOfNames'], {'cn': 'a'})
+    plan.delete('cn=a')
+
+    assert _operations(plan) == [(LDAPOperation.DELETE, 'cn=a')]
+
+
+def test_phases_order_deletes_adds_modifies():
+    plan = ChangePlan()
+    plan.modify('cn=c', _member_changes('uid=1'))
+    plan.add('cn=b', ['groupOfNames'], {'cn': 'b'})
+    plan.delete('cn=a')
+
+    assert [[(operation.operation, operation.dn) for operation in phase] for phase in plan.phases()] == [
+        [(LDAPOperation.DELETE, 'cn=a')], [(LDAPOperation.ADD, 'cn=b')], [(LDAPOperation.MODIFY, 'cn=c')]]
+
+
+def test_to_json_encodes_binary_values():
+    plan = ChangePlan()
+    plan.modify('uid=a', {'jpegPhoto': [(ldap3.MODIFY_REPLACE, [b'\x00\xff'])]})
+
+    assert json.loads(plan.to_json()) == [{'operation': 'modify', 'dn': 'uid=a', 'changes': {
+        'jpegPhoto': [{'operation': ldap3.MODIFY_REPLACE, 'values': [{'base64': 'AP8='}]}]}}]
+
+
+@pytest.fixture
+def ldap_server():
+    server = ldap3.Server('ldap-test')
+    connection = ldap3.Connection(server, user=BINDDN, password=PASSWORD, client_strategy=ldap3.MOCK_SYNC)
+    connection.strategy.add_entry(BASE_DN, {'objectClass': ['dcObject', 'organization'], 'dc': 'example'})
+    connection.strategy.add_entry(BINDDN, {'objectClass': ['person'], 'cn': 'admin', 'sn': 'admin',
+                                           'userPassword': PASSWORD})
+    return server
+
+
+def _executor(ldap_server, connections=2):
+    return PlanExecutor(ldap_server, BINDDN, PASSWORD, connections=connections, client_strategy=ldap3.MOCK_ASYNC)
+
+
+def _entry(ldap_server, dn):
+    connection = ldap3.Connection(ldap_server, user=BINDDN, password=PASSWORD, client_strategy=ldap3.MOCK_SYNC)
+    connection.bind()
+    if not connection.search(dn, '(objectClass=*)', search_scope=ldap3.BASE, attributes=['member']):
+        return None
+    return connection.entries[0]
+
+
+def test_executor_applies_plan(ldap_server):
+    plan = ChangePlan()
+    plan.add(f'cn=a,{BASE_DN}', ['groupOfNames'], {'cn': 'a', 'member': ['uid=1']})
+    plan.modify(f'cn=a,{BASE_DN}', _member_changes('uid=2'))
+
+    results = _executor(ldap_server).apply(plan)
+
+    assert [success for _, success, _ in results] == [True, True]
+    assert sorted(_entry(ldap_server, f'cn=a,{BASE_DN}').member.values) == ['uid=1', 'uid=2']
+
+
+def test_executor_reports_failed_operations(ldap_server):
+    plan = ChangePlan()
+    plan.delete(f'cn=missing,{BASE_DN}')
+
+    [(_, success, description)] = _executor(ldap_server).apply(plan)
+
+    assert not success
+    assert description == 'noSuchObject'
+
+
+def test_executor_fails_on_bind_errors(ldap_server):
+    with pytest.raises(LDAPBindError):
+        PlanExecutor(ldap_server, BINDDN, 'wrong', client_strategy=ldap3.MOCK_ASYNC)
+
+
+def test_executor_retries_operations_that_lost_their_response(ldap_server, monkeypatch):
+    # The add is applied, but its response never arrives
+    lost = []
+    connect = PlanExecutor._connect
+
+    def connect_losing_first_response(executor):
+        connection = connect(executor)
+        get_response = connection.get_response
+
+        def get_response_once(message_id, *args, **kwargs):
+            if not lost:
+                lost.append(message_id)
+                raise LDAPResponseTimeoutError('no response')
+            return get_response(message_id, *args, **kwargs)
+        connection.get_response = get_response_once
+        return connection
+    monkeypatch.setattr(PlanExecutor, '_connect', connect_losing_first_response)
+
+    executor = _executor(ldap_server, connections=1)
+    plan = ChangePlan()
+    plan.add(f'cn=a,{BASE_DN}', ['groupOfNames'], {'cn': 'a', 'member': ['uid=1']})
+
+    [(_, success, description)] = executor.apply(plan)
+
+    assert lost
+    assert success
+    assert description.startswith('entryAlreadyExists')
+
+
+def test_executor_reconnects_idle_connections(ldap_server):
+    executor = _executor(ldap_server, connections=1)
+    connection = executor.connections[0]
+    executor.last_used -= PlanExecutor.IDLE_SECONDS + 1
+
+    executor.apply(ChangePlan())
+
+    assert executor.connections[0] is not connection
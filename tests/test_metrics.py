@@ -0,0 +1,62 @@
+from metrics import Metrics, merge_summaries
+
+
+def test_cycle_summary_counts_only_the_cycle():
+    metrics = Metrics()
+    metrics.inc('ldap_writes_total', 3, operation='add')
+
+    metrics.start_cycle()
+    metrics.inc('ldap_writes_total', 2, operation='add')
+    metrics.inc('ldap_writes_total', operation='delete')
+    metrics.inc('runs_total')
+    metrics.observe('phase_seconds', 0.2, phase='plan')
+    summary = metrics.end_cycle()
+
+    assert summary['counters'] == {'ldap_writes_total': {'{operation="add"}': 2, '{operation="delete"}': 1},
+                                   'runs_total': {'total': 1}}
+    assert summary['timings'] == {'phase_seconds': {'{phase="plan"}': {'count': 1, 'seconds': 0.2}}}
+
+    metrics.start_cycle()
+    assert metrics.end_cycle()['counters'] == {}
+
+
+def test_timed_generators_are_timed_until_exhausted():
+    metrics = Metrics()
+
+    @metrics.timed('load_seconds')
+    def load():
+        yield from range(3)
+
+    generator = load()
+    assert next(generator) == 0
+    assert metrics.histograms == {}
+    assert list(generator) == [1, 2]
+    assert metrics.histograms[('load_seconds', ())][2] == 1
+
+
+def test_prometheus_exposition():
+    metrics = Metrics()
+    metrics.inc('runs_total', action='sync "users"')
+    metrics.observe('phase_seconds', 0.02)
+    metrics.observe('phase_seconds', 60)
+
+    lines = metrics.to_prometheus().splitlines()
+
+    assert '# TYPE rc_sync_runs_total counter' in lines
+    assert 'rc_sync_runs_total{action="sync \\"users\\""} 1' in lines
+    assert 'rc_sync_phase_seconds_bucket{le="0.01"} 0' in lines
+    assert 'rc_sync_phase_seconds_bucket{le="0.025"} 1' in lines
+    assert 'rc_sync_phase_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'rc_sync_phase_seconds_count 2' in lines
+
+
+def test_merge_summaries():
+    merged = merge_summaries([
+        {'cycle_started_at': 20, 'cycle_seconds': 1.5, 'counters': {'runs_total': {'total': 1}},
+         'timings': {'phase_seconds': {'total': {'count': 1, 'seconds': 0.5}}}},
+        {'cycle_started_at': 10, 'cycle_seconds': 2.5, 'counters': {'runs_total': {'total': 2}},
+         'timings': {'phase_seconds': {'total': {'count': 2, 'seconds': 0.25}}}},
+        {'cycle_started_at': None, 'cycle_seconds': 0, 'counters': {}, 'timings': {}}])
+
+    assert merged == {'cycle_started_at': 10, 'cycle_seconds': 2.5, 'counters': {'runs_total': {'total': 3}},
+                      'timings': {'phase_seconds': {'total': {'count': 3, 'seconds': 0.75}}}}
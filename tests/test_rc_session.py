@@ -0,0 +1,127 @@
+import requests
+from requests.adapters import BaseAdapter
+
+import rc_session
+from rc_session import RateLimit, RateLimitedSession
+
+URL = 'https://rc.example.org/api/v1/users.list'
+
+
+def _headers(limit, remaining, reset):
+    return {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(reset)}
+
+
+def test_unknown_limit_never_waits():
+    assert RateLimit().reserve(0) == 0
+
+
+def test_waits_for_the_reset_once_the_tokens_are_used():
+    rate_limit = RateLimit()
+    rate_limit.update(_headers(10, 2, 100))
+
+    assert rate_limit.reserve(90) == 0
+    assert rate_limit.reserve(90) == 0
+    assert rate_limit.reserve(90) == 10
+    # The window reset refills the bucket
+    assert rate_limit.reserve(100) == 0
+    assert rate_limit.remaining == 9
+
+
+def test_reset_in_milliseconds_and_long_waits_are_capped():
+    rate_limit = RateLimit()
+    rate_limit.update(_headers(10, 0, 2_000_000_000_000))
+
+    assert rate_limit.reset_at == 2_000_000_000
+    assert rate_limit.reserve(0) == RateLimit.MAX_WAIT_SECONDS
+
+
+def test_invalid_headers_are_ignored():
+    rate_limit = RateLimit()
+    rate_limit.update({'X-RateLimit-Limit': 'x'})
+
+    assert rate_limit.limit is None
+
+
+class FakeAdapter(BaseAdapter):
+    def __init__(self, statuses, headers=None):
+        super().__init__()
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.requests = 0
+
+    def send(self, request, **kwargs):
+        self.requests += 1
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.headers.update(self.headers)
+        response.request = request
+        response.url = request.url
+        response._content = b'{}'
+        return response
+
+    def close(self):
+        pass
+
+
+def _session(monkeypatch, adapter, max_retries=RateLimitedSession.MAX_RETRIES):
+    sleeps = []
+    monkeypatch.setattr(rc_session.time, 'sleep', sleeps.append)
+    session = RateLimitedSession(max_retries=max_retries)
+    session.mount('https://rc.example.org', adapter)
+    return session, sleeps
+
+
+def test_throttled_requests_are_retried(monkeypatch):
+    adapter = FakeAdapter([429, 503, 200], headers={'Retry-After': '3'})
+    session, sleeps = _session(monkeypatch, adapter)
+
+    assert session.get(URL).status_code == 200
+    assert adapter.requests == 3
+    assert sleeps == [3, 3]
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    adapter = FakeAdapter([503] * 3)
+    session, sleeps = _session(monkeypatch, adapter, max_retries=2)
+
+    assert session.get(URL).status_code == 503
+    assert adapter.requests == 3
+    assert len(sleeps) == 2
+
+
+def test_client_errors_are_not_retried(monkeypatch):
+    adapter = FakeAdapter([400])
+    session, sleeps = _session(monkeypatch, adapter)
+
+    assert session.get(URL).status_code == 400
+    assert adapter.requests == 1
+    assert sleeps == []
+
+
+class FakeClock:
+    # time.time() that advances by the time slept
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_exhausted_endpoint_waits_for_its_reset(monkeypatch):
+    clock = FakeClock(1000)
+    monkeypatch.setattr(rc_session.time, 'time', clock.time)
+    adapter = FakeAdapter([200, 200], headers=_headers(10, 0, 1005))
+    session, _ = _session(monkeypatch, adapter)
+    monkeypatch.setattr(rc_session.time, 'sleep', clock.sleep)
+
+    session.get(URL)
+    session.get(URL)
+
+    assert clock.sleeps == [5]
+    assert adapter.requests == 2
@@ -0,0 +1,68 @@
+from scheduler import Job, Scheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_job_stays_on_its_grid():
+    job = Job('users', 60)
+
+    assert job.advance(10) == 0
+    assert job.next_run == 60
+    assert job.advance(75) == 0
+    assert job.next_run == 120
+
+
+def test_job_skips_ticks_it_overran():
+    job = Job('users', 60)
+
+    assert job.advance(130) == 2
+    assert job.next_run == 180
+
+
+def test_jitter_delays_within_its_share_of_the_interval():
+    job = Job('users', 60, jitter=0.1)
+
+    job.advance(0)
+    assert 60 <= job.next_run <= 66
+
+
+def test_scheduler_runs_due_jobs_together_in_order():
+    clock = FakeClock()
+    scheduler = Scheduler(jitter=0, clock=clock)
+    scheduler.add('users', 60)
+    scheduler.add('channels', 120)
+    runs = []
+
+    def callback(names):
+        runs.append((clock.now, names))
+        if len(runs) == 3:
+            scheduler.stop()
+    scheduler.stopped.wait = lambda timeout: setattr(clock, 'now', clock.now + timeout)
+
+    scheduler.run(callback)
+
+    assert runs == [(0, ['users', 'channels']), (60, ['users']), (120, ['users', 'channels'])]
+
+
+def test_failing_run_does_not_stop_the_scheduler():
+    clock = FakeClock()
+    scheduler = Scheduler(jitter=0, clock=clock)
+    scheduler.add('users', 60)
+    runs = []
+
+    def callback(names):
+        runs.append(clock.now)
+        if len(runs) == 2:
+            scheduler.stop()
+        raise RuntimeError('sync failed')
+    scheduler.stopped.wait = lambda timeout: setattr(clock, 'now', clock.now + timeout)
+
+    scheduler.run(callback)
+
+    assert runs == [0, 60]
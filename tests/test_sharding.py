@@ -0,0 +1,48 @@
+import collections
+
+from sharding import GroupLocks, process_of, shard_of
+
+GROUPS = [f'group-{i}' for i in range(1000)]
+
+
+def test_shard_of_is_stable_and_in_range():
+    shards = [shard_of(name, {}, 4) for name in GROUPS]
+
+    assert shards == [shard_of(name, {}, 4) for name in GROUPS]
+    assert set(shards) == {0, 1, 2, 3}
+
+
+def test_shard_of_spreads_groups_evenly():
+    counts = collections.Counter(shard_of(name, {}, 4) for name in GROUPS)
+
+    assert all(200 <= count <= 300 for count in counts.values())
+
+
+def test_explicit_shard_wins():
+    assert shard_of('group-0', {'shard': 5}, 4) == 1
+    assert shard_of('group-0', {'shard': '2'}, 4) == 2
+
+
+def test_adding_a_shard_only_moves_groups_to_it():
+    for name in GROUPS:
+        before, after = shard_of(name, {}, 4), shard_of(name, {}, 5)
+        assert after in (before, 4)
+
+
+def test_process_of_splits_the_groups_of_a_shard():
+    shard_groups = [name for name in GROUPS if shard_of(name, {}, 4) == 0]
+    counts = collections.Counter(process_of(name, 2) for name in shard_groups)
+
+    assert set(counts) == {0, 1}
+    assert min(counts.values()) > len(shard_groups) / 3
+
+
+def test_group_locks_are_exclusive(tmp_path):
+    locks, other_locks = GroupLocks(str(tmp_path)), GroupLocks(str(tmp_path))
+
+    assert locks.acquire('group-0')
+    assert not other_locks.acquire('group-0')
+    assert other_locks.acquire('group-1')
+
+    locks.release('group-0')
+    assert other_locks.acquire('group-0')
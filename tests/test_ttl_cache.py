@@ -0,0 +1,68 @@
+from ttl_cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_expire_drops_only_old_entries():
+    clock = FakeClock()
+    cache = TTLCache(10, clock=clock)
+    cache['old'] = 1
+    clock.now = 6
+    cache['new'] = 2
+
+    clock.now = 10
+    assert cache.expire() == 0
+    clock.now = 11
+    assert cache.expire() == 1
+    assert cache == {'new': 2}
+
+
+def test_entries_stay_until_expire_is_called():
+    clock = FakeClock()
+    cache = TTLCache(10, clock=clock)
+    cache['key'] = 1
+
+    clock.now = 100
+    assert cache['key'] == 1
+
+
+def test_storing_again_renews_the_entry():
+    clock = FakeClock()
+    cache = TTLCache(10, clock=clock)
+    cache['key'] = 1
+    clock.now = 8
+    cache['key'] = 2
+
+    clock.now = 15
+    assert cache.expire() == 0
+    assert cache == {'key': 2}
+
+
+def test_removed_entries_are_not_expired_again():
+    clock = FakeClock()
+    cache = TTLCache(10, clock=clock)
+    cache['deleted'] = cache['popped'] = cache['cleared'] = 1
+    del cache['deleted']
+    cache.pop('popped')
+
+    clock.now = 20
+    assert cache.expire() == 1
+    cache['cleared'] = 1
+    cache.clear()
+    assert cache.expire() == 0
+
+
+def test_no_ttl_never_expires():
+    clock = FakeClock()
+    cache = TTLCache(clock=clock)
+    cache['key'] = 1
+
+    clock.now = 10 ** 6
+    assert cache.expire() == 0
+    assert cache == {'key': 1}
@@ -0,0 +1,98 @@
+import datetime
+import sqlite3
+import types
+
+import ldap3
+
+from ldap_client import LDAPClient
+from warm_start import WarmStart
+
+BASE_DN = 'dc=example,dc=org'
+BINDDN = f'cn=admin,{BASE_DN}'
+PASSWORD = 'secret'
+SNAPSHOT_KEY = (BASE_DN, ('inetOrgPerson',))
+LOADED_AT = datetime.datetime(2024, 1, 2, 3, 4, 5)
+
+
+def _clients(users, rc_version='6.5.0', room_directory=None):
+    ldap_client = types.SimpleNamespace(
+        ldap_base_dn=BASE_DN, default_users_objectclasses=['inetOrgPerson'],
+        snapshot_key=lambda base_dn, objectclasses: (base_dn, tuple(objectclasses)),
+        user_snapshots={SNAPSHOT_KEY: users}, snapshot_loaded_at={SNAPSHOT_KEY: LOADED_AT})
+    rc_client = types.SimpleNamespace(rc_version=rc_version,
+                                      room_directory=room_directory if room_directory is not None else {})
+    return ldap_client, rc_client
+
+
+def _user(uid, **attributes):
+    dn = f'uid={uid},{BASE_DN}'
+    return dn, {'dn': dn, 'attributes': {'uid': [uid], **attributes}}
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'warm.sqlite')
+    users = dict([_user('alice', jpegPhoto=[b'\x00\xff'], rocketchatId=['id-1'])])
+    WarmStart(path).save(*_clients(users, room_directory={'general': ('room-1', 'c')}))
+
+    warm_start = WarmStart(path)
+
+    assert warm_start.rc_version == '6.5.0'
+    assert warm_start.room_directory == {'general': ('room-1', 'c')}
+    assert 0 <= warm_start.age < 60
+    assert warm_start.get_ldap_users(SNAPSHOT_KEY) == (users, LOADED_AT)
+    # The users are handed out once, the client keeps them up to date from then on
+    assert warm_start.get_ldap_users(SNAPSHOT_KEY) is None
+
+
+def test_snapshot_of_another_search_is_not_used(tmp_path):
+    path = str(tmp_path / 'warm.sqlite')
+    WarmStart(path).save(*_clients(dict([_user('alice')])))
+
+    assert WarmStart(path).get_ldap_users((BASE_DN, ('posixAccount',))) is None
+
+
+def test_missing_other_version_and_broken_snapshots_start_cold(tmp_path):
+    assert WarmStart(str(tmp_path / 'missing.sqlite')).get_ldap_users(SNAPSHOT_KEY) is None
+
+    path = str(tmp_path / 'warm.sqlite')
+    WarmStart(path).save(*_clients(dict([_user('alice')])))
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("UPDATE meta SET value = '0' WHERE key = 'version'")
+    connection.close()
+    assert WarmStart(path).get_ldap_users(SNAPSHOT_KEY) is None
+
+    broken_path = tmp_path / 'broken.sqlite'
+    broken_path.write_bytes(b'not a database')
+    warm_start = WarmStart(str(broken_path))
+    assert warm_start.get_ldap_users(SNAPSHOT_KEY) is None
+    assert warm_start.room_directory is None
+
+
+def test_ldap_client_revalidates_the_snapshot(tmp_path):
+    server = ldap3.Server('ldap-test')
+    connection = ldap3.Connection(server, user=BINDDN, password=PASSWORD, client_strategy=ldap3.MOCK_SYNC)
+    connection.strategy.add_entry(BASE_DN, {'objectClass': ['dcObject', 'organization'], 'dc': 'example'})
+    connection.strategy.add_entry(BINDDN, {'objectClass': ['person'], 'cn': 'admin', 'sn': 'admin',
+                                           'userPassword': PASSWORD})
+    for uid in ('alice', 'bob'):
+        connection.strategy.add_entry(f'uid={uid},{BASE_DN}', {'objectClass': ['inetOrgPerson'], 'uid': uid,
+                                                               'cn': uid, 'sn': uid, 'rocketchatId': f'id-{uid}'})
+
+    def ldap_client(warm_start=None):
+        return LDAPClient(binddn=BINDDN, password=PASSWORD, base_dn=BASE_DN,
+                          default_users_objectclasses=['inetOrgPerson'], ldap_server=server,
+                          client_strategy=ldap3.MOCK_SYNC, warm_start=warm_start)
+
+    path = str(tmp_path / 'warm.sqlite')
+    WarmStart(path).save(ldap_client(), types.SimpleNamespace(rc_version=None, room_directory={}))
+
+    # Deleted after the snapshot was saved
+    connection.bind()
+    connection.delete(f'uid=bob,{BASE_DN}')
+
+    client = ldap_client(WarmStart(path))
+
+    assert list(client.all_users) == [f'uid=alice,{BASE_DN}']
+    assert client.get_user_dn_by_rocketchat_id('id-alice') == f'uid=alice,{BASE_DN}'
+    assert client.get_user_dn_by_uid('bob') is None
@@ -0,0 +1,38 @@
+import time
+
+
+class TTLCache(dict):
+    # A dict whose entries are dropped by expire() once they are older than ttl seconds. Expiry is explicit, so
+    # entries do not vanish in the middle of a sync run.
+    def __init__(self, ttl=None, clock=time.monotonic):
+        super().__init__()
+        self.ttl = ttl
+        self.clock = clock
+        self._stored_at = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._stored_at[key] = self.clock()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._stored_at.pop(key, None)
+
+    def pop(self, key, *default):
+        self._stored_at.pop(key, None)
+        return super().pop(key, *default)
+
+    def clear(self):
+        super().clear()
+        self._stored_at.clear()
+
+    def expire(self):
+        # Returns the number of dropped entries
+        if self.ttl is None:
+            return 0
+
+        deadline = self.clock() - self.ttl
+        expired = [key for key, stored_at in list(self._stored_at.items()) if stored_at < deadline]
+        for key in expired:
+            self.pop(key, None)
+        return len(expired)
@@ -0,0 +1,112 @@
+import base64
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_value(value):
+    if isinstance(value, bytes):
+        return {'base64': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, list):
+        return [_encode_value(item) for item in value]
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and 'base64' in value:
+        return base64.b64decode(value.get('base64'))
+    if isinstance(value, list):
+        return [_decode_value(item) for item in value]
+    return value
+
+
+class WarmStart:
+    # The reconciled state of the last run in a sqlite file, so a restart revalidates it instead of loading all
+    # of LDAP and Rocket.Chat again. Photos are not kept, the avatar cache has them.
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = {}
+        self.ldap_users = None
+        self.room_directory = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            connection = sqlite3.connect(self.path)
+            try:
+                meta = dict(connection.execute('SELECT key, value FROM meta'))
+                if meta.get('version') != str(self.VERSION):
+                    logger.info(f'Ignoring warm start snapshot {self.path} of version {meta.get("version")}')
+                    return
+                ldap_users = {dn: {'dn': dn, 'attributes': {name: _decode_value(value)
+                                                            for name, value in json.loads(attributes).items()}}
+                              for dn, attributes in connection.execute('SELECT dn, attributes FROM ldap_users')}
+                room_directory = {name: (room_id, room_type) for name, room_id, room_type in
+                                  connection.execute('SELECT name, id, type FROM rooms')}
+            finally:
+                connection.close()
+        except (sqlite3.Error, ValueError) as exc:
+            logger.warning(f'Could not read warm start snapshot {self.path}, starting cold: {exc}')
+            return
+
+        self.meta, self.ldap_users, self.room_directory = meta, ldap_users, room_directory
+        logger.info(f'Loaded warm start snapshot with {len(ldap_users)} LDAP users and {len(room_directory)} rooms')
+
+    @property
+    def age(self):
+        return time.time() - float(self.meta.get('saved_at', 0))
+
+    @property
+    def rc_version(self):
+        return self.meta.get('rc_version')
+
+    def get_ldap_users(self, snapshot_key):
+        # Returns the users and when they were loaded from LDAP, if the snapshot is of the same search
+        if self.ldap_users is None or self.meta.get('ldap_users_key') != json.dumps(snapshot_key):
+            return None
+        users, self.ldap_users = self.ldap_users, None
+        return users, datetime.datetime.fromisoformat(self.meta.get('ldap_users_loaded_at'))
+
+    def save(self, ldap_client, rc_client):
+        ldap_users_key = ldap_client.snapshot_key(ldap_client.ldap_base_dn, ldap_client.default_users_objectclasses)
+        ldap_users = ldap_client.user_snapshots.get(ldap_users_key)
+        ldap_users_loaded_at = ldap_client.snapshot_loaded_at.get(ldap_users_key)
+
+        meta = {'version': str(self.VERSION), 'saved_at': str(time.time())}
+        if rc_client.rc_version is not None:
+            meta['rc_version'] = rc_client.rc_version
+        if ldap_users is not None and ldap_users_loaded_at is not None:
+            meta['ldap_users_key'] = json.dumps(ldap_users_key)
+            meta['ldap_users_loaded_at'] = ldap_users_loaded_at.isoformat()
+        else:
+            ldap_users = {}
+
+        # Written next to the snapshot and moved over it, so a crash never leaves half a snapshot
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        try:
+            with connection:
+                connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+                connection.execute('CREATE TABLE ldap_users (dn TEXT PRIMARY KEY, attributes TEXT)')
+                connection.execute('CREATE TABLE rooms (name TEXT PRIMARY KEY, id TEXT, type TEXT)')
+                connection.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+                connection.executemany('INSERT INTO ldap_users VALUES (?, ?)', (
+                    (dn, json.dumps({name: _encode_value(value)
+                                     for name, value in user.get('attributes', {}).items()}))
+                    for dn, user in list(ldap_users.items())))
+                connection.executemany('INSERT INTO rooms VALUES (?, ?, ?)', (
+                    (name, room_id, room_type) for name, (room_id, room_type) in list(rc_client.room_directory.items())))
+        finally:
+            connection.close()
+        os.replace(tmp_path, self.path)